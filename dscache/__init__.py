@@ -5,11 +5,21 @@ from .dscache import (ds2bytes,
                       create_cache,
                       open_rw,
                       open_ro)
+from .aio import AsyncDatasetCache
+from .metrics import CacheStats
+from .keys import pack_key, unpack_key
+from .sharded import ShardedDatasetCache, create_sharded_cache
 
 __all__ = ['ds2bytes',
            'create_cache',
            'open_ro',
            'open_rw',
            'DatasetCache',
+           'AsyncDatasetCache',
+           'CacheStats',
+           'ShardedDatasetCache',
+           'create_sharded_cache',
            'key_to_bytes',
+           'pack_key',
+           'unpack_key',
            'train_dictionary']
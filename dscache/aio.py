@@ -0,0 +1,237 @@
+""" asyncio interface for dataset cache reads
+"""
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from uuid import UUID
+
+from .dscache import (key_to_bytes, _decode_dss,
+                      _worker_args, _init_decode_worker, _decode_worker)
+
+
+class AsyncDatasetCache(object):
+    """Async wrapper around ``DatasetCache`` for use from asyncio code.
+
+    Raw records are read in short read transactions on a thread of the loop's
+    default executor, decompression, JSON parsing and ``Dataset``
+    construction are offloaded to the decode executor in batches.
+
+    Streaming methods keep at most ``max_pending`` batches in flight, so a slow
+    consumer stops further reads rather than accumulating decoded datasets.
+    """
+
+    def __init__(self, cache,
+                 executor=None,
+                 max_workers=None,
+                 processes=False,
+                 batch_size=100,
+                 max_pending=4):
+        """
+        :cache: DatasetCache instance
+        :executor: ThreadPoolExecutor to use for decode, default is to create private pool
+        :max_workers int: Number of workers for private pool
+        :processes bool: Make private pool a process pool, workers are
+                         initialised with product definitions of the cache
+        :batch_size int: Number of records to decode per task
+        :max_pending int: Maximum number of decode tasks in flight per stream
+        """
+        assert batch_size > 0 and max_pending > 0
+
+        if isinstance(executor, ProcessPoolExecutor):
+            raise ValueError('Workers of a process pool need product definitions, '
+                             'use processes=True instead of passing one')
+
+        self._cache = cache
+        self._own_executor = executor is None
+        self._procs = executor is None and processes
+        if self._procs:
+            self._executor = ProcessPoolExecutor(max_workers=max_workers,
+                                                 initializer=_init_decode_worker,
+                                                 initargs=_worker_args(cache))
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=max_workers) if executor is None else executor
+        self._batch_size = batch_size
+        self._max_pending = max_pending
+
+    @property
+    def cache(self):
+        return self._cache
+
+    @property
+    def products(self):
+        return self._cache.products
+
+    @property
+    def count(self):
+        return self._cache.count
+
+    def close(self):
+        """ Shutdown private executor if one was created
+        """
+        if self._own_executor:
+            self._executor.shutdown(wait=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+    def _read(self, fn, *args):
+        """ Run cache read method on a thread, returns awaitable result
+        """
+        return asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+    def _submit(self, batch):
+        """ Schedule decode of a list of raw records, returns awaitable list of datasets
+        """
+        loop = asyncio.get_running_loop()
+        cache = self._cache
+
+        if not self._procs:
+            return loop.run_in_executor(self._executor, _decode_dss,
+                                        cache._zdict, cache.products, batch, cache._intern)
+
+        if cache._intern is not None:
+            cache._intern.refresh()  # worker copies can not load new entries themselves
+        return loop.run_in_executor(self._executor, _decode_worker, batch, cache._intern)
+
+    async def _decode_stream(self, raw_batches):
+        """ Decode stream of raw batches keeping at most max_pending in flight.
+
+        :raw_batches: Async iterator of lists of raw records, each batch must be
+        produced without leaving a transaction open.
+        """
+        pending = deque()
+        try:
+            async for batch in raw_batches:
+                if len(batch) == 0:
+                    continue
+                pending.append(self._submit(batch))
+
+                if len(pending) >= self._max_pending:
+                    for ds in await pending.popleft():
+                        yield ds
+
+            while pending:
+                for ds in await pending.popleft():
+                    yield ds
+        finally:
+            for fut in pending:
+                fut.cancel()
+
+    async def get(self, uuid):
+        """Extract single dataset with a given uuid, or return None if not found"""
+        dss = await self.get_many([uuid])
+        return dss[0]
+
+    async def get_many(self, uuids):
+        """Extract several datasets, returns list of the same length as input with
+        None in place of missing datasets.
+        """
+        keys = [key_to_bytes(UUID(u) if isinstance(u, str) else u) for u in uuids]
+
+        out = [None]*len(keys)
+        todo = []
+        for i, d in enumerate(await self._read(self._cache._get_raw_many, keys)):
+            if d is not None:
+                todo.append((i, d))
+
+        async def raw_batches():
+            for n in range(0, len(todo), self._batch_size):
+                yield [d for _, d in todo[n:n+self._batch_size]]
+
+        n = 0
+        async for ds in self._decode_stream(raw_batches()):
+            out[todo[n][0]] = ds
+            n += 1
+
+        return out
+
+    def get_all(self):
+        """ Async iterator over all datasets in the cache
+        """
+        async def raw_batches():
+            pos = None
+            while True:
+                batch, pos = await self._read(self._cache._scan_raw, pos, self._batch_size)
+                yield batch
+                if pos is None:
+                    break
+
+        return self._decode_stream(raw_batches())
+
+    def stream_group(self, group_name, raw=False):
+        """ Async iterator over datasets in a named group, raises ValueError
+        on first iteration if group is missing. Members deleted after the
+        group was read are skipped.
+
+        :raw bool: Name is an encoded key as returned by ``groups(raw=True)``
+        """
+        cache = self._cache
+        step = self._batch_size*16
+
+        async def raw_batches():
+            uu = await self._read(cache._get_group_raw, group_name, raw)
+            if uu is None:
+                raise ValueError('No such group: %s' % (group_name,))
+
+            if len(uu) & 0xF:
+                raise ValueError('Wrong data size for group %s' % (group_name,))
+
+            for i in range(0, len(uu), step):
+                keys = [uu[n:n+16] for n in range(i, min(i+step, len(uu)), 16)]
+                batch = await self._read(cache._get_raw_many, keys)
+                missing = [k for k, d in zip(keys, batch) if d is None]
+                if missing:
+                    dead = await self._read(cache._tombstoned, missing)
+                    for k in missing:
+                        if k not in dead:
+                            raise ValueError('Missing dataset for %s' % (str(UUID(bytes=k))))
+                    batch = [d for d in batch if d is not None]  # deleted after group was read
+                yield batch
+
+        return self._decode_stream(raw_batches())
+
+
+def test_get_many(tmp_path):
+    from uuid import uuid4
+    from .dscache import create_cache
+    from .tools.synthetic import gen_datasets
+
+    dss = list(gen_datasets(20))
+    cache = create_cache(str(tmp_path/'a.db'))
+    cache.bulk_save(dss)
+    cache.sync()
+
+    uu = [ds.id for ds in dss[::-1]]
+    uu[3:3] = [uuid4()]
+    expect = uu[:3] + [None] + uu[4:]
+
+    async def get_many(processes):
+        async with AsyncDatasetCache(cache, processes=processes, batch_size=3, max_pending=2) as a:
+            return await a.get_many(uu)
+
+    for processes in (False, True):
+        assert [None if ds is None else ds.id for ds in asyncio.run(get_many(processes))] == expect
+
+
+def test_stream_group_deleted(tmp_path):
+    from .dscache import create_cache
+    from .tools.synthetic import gen_datasets
+
+    dss = list(gen_datasets(10))
+    cache = create_cache(str(tmp_path/'d.db'))
+    cache.bulk_save(dss)
+    cache.put_group('g', [ds.id for ds in dss])
+
+    async def stream():
+        out = []
+        async with AsyncDatasetCache(cache, batch_size=2, max_pending=1) as a:
+            async for ds in a.stream_group('g'):
+                if len(out) == 0:
+                    cache.delete(dss[5].id)  # group is already read at this point
+                out.append(ds.id)
+        return out
+
+    assert asyncio.run(stream()) == [ds.id for ds in dss if ds is not dss[5]]
@@ -0,0 +1,177 @@
+import click
+
+
+@click.group('dscache')
+def cli():
+    """Dataset cache maintenance tools.
+    """
+    pass
+
+
+@cli.command('merge')
+@click.option('--complevel', type=int, default=6, help='Compression level used when recompressing')
+@click.option('--max-db-sz', type=int, help='Maximum size of the output in Gb')
+@click.option('--overwrite', is_flag=True, help='Replace output if it exists')
+@click.argument('output', type=str, nargs=1)
+@click.argument('inputs', type=str, nargs=-1)
+def merge(complevel, max_db_sz, overwrite, output, inputs):
+    """Merge several caches into one.
+
+    Datasets, products and groups are combined, groups with the same name are
+    merged. Records are copied without recompression when compression
+    dictionaries match.
+    """
+    from dscache.tools.merge import merge_caches
+
+    if len(inputs) == 0:
+        click.echo('Have to supply at least one input')
+        raise click.Abort()
+
+    rr = merge_caches(output, inputs,
+                      complevel=complevel,
+                      max_db_sz=None if max_db_sz is None else max_db_sz*(1 << 30),
+                      truncate=overwrite)
+
+    click.echo('Datasets    : {:,d} ({:,d} copied, {:,d} recompressed, {:,d} duplicates, '
+               '{:,d} already present)'.format(
+                   rr.datasets, rr.copied, rr.recompressed, rr.duplicates, rr.existing))
+    click.echo('Groups      : {:,d}'.format(rr.groups))
+    click.echo('Products    : {:,d}'.format(rr.products))
+
+
+@cli.command('export')
+@click.option('--field', '-f', 'fields', type=str, multiple=True,
+              help='Column to export, can be repeated (default: id,product,time,uris,extent)')
+@click.option('--batch-size', type=int, default=10000, help='Datasets per record batch')
+@click.option('--workers', type=int, help='Number of decode processes, 0 to decode in-process')
+@click.argument('dbfile', type=str, nargs=1)
+@click.argument('output', type=str, nargs=1)
+def export(fields, batch_size, workers, dbfile, output):
+    """Export datasets to a Parquet file, one row per dataset.
+
+    Fields are: id, product, time, uris, extent (WKT in lon/lat), crs,
+    doc:dotted.path for any value in the metadata document, or a search field
+    name of the metadata type.
+    """
+    import dscache
+    from dscache.tools.export import export_parquet, DEFAULT_FIELDS
+
+    cache = dscache.open_ro(dbfile)
+    n = export_parquet(cache, output,
+                       fields=fields or DEFAULT_FIELDS,
+                       batch_size=batch_size,
+                       workers=workers)
+    click.echo('Wrote {:,d} rows to {}'.format(n, output))
+
+
+@cli.command('info')
+@click.option('--sample', type=int, help='Estimate per product numbers from this many random records')
+@click.option('--max-db-sz', type=int, help='Report free space relative to this size in Gb')
+@click.option('--json', 'as_json', is_flag=True, help='Output JSON instead of text')
+@click.argument('dbfile', type=str, nargs=1)
+def info(sample, max_db_sz, as_json, dbfile):
+    """Report dataset, group and storage statistics of a cache.
+    """
+    import json
+    import dscache
+    from dscache.tools.info import cache_info, info2text, info2dict
+
+    cache = dscache.open_ro(dbfile)
+    if isinstance(cache, dscache.ShardedDatasetCache):
+        shards = [(str(cache.path/name), shard)
+                  for name, shard in zip(cache.manifest['shards'], cache.shards)
+                  if shard is not None]
+    else:
+        shards = [(dbfile, cache)]
+
+    map_size = None if max_db_sz is None else max_db_sz*(1 << 30)
+    report = {path: cache_info(shard, sample=sample, map_size=map_size) for path, shard in shards}
+
+    if as_json:
+        click.echo(json.dumps(info2dict(report), indent=2))
+        return
+
+    for path, rr in report.items():
+        if len(report) > 1:
+            click.echo('== {}'.format(path))
+        click.echo(info2text(rr))
+
+
+@cli.command('check')
+@click.option('--workers', type=int, help='Number of worker processes, 0 to run in-process')
+@click.option('--repair', is_flag=True, help='Delete broken records and dangling group members')
+@click.option('--max-report', type=int, default=20, help='Maximum number of problems to print')
+@click.argument('dbfile', type=str, nargs=1)
+def check(workers, repair, max_report, dbfile):
+    """Verify integrity of records and groups.
+
+    Exits with status 1 if any problems were found.
+    """
+    import sys
+    from dscache.tools.check import check_cache
+
+    rr = check_cache(dbfile, workers=workers, repair=repair,
+                     log=lambda msg: click.echo(msg, err=True))
+
+    click.echo('Checked {:,d} datasets and {:,d} groups'.format(rr.datasets, rr.groups))
+
+    for path, uuid, err in rr.bad_records[:max_report]:
+        click.echo('  record {} ({}): {}'.format(uuid, path, err))
+
+    for path, name, err, _ in rr.bad_groups[:max_report]:
+        click.echo('  group {} ({}): {}'.format(name.decode('utf8', 'backslashreplace'), path, err))
+
+    n_bad = len(rr.bad_records) + len(rr.bad_groups)
+    if n_bad == 0:
+        click.echo('No problems found')
+        return
+
+    click.echo('Found {:,d} broken records and {:,d} broken groups'.format(
+        len(rr.bad_records), len(rr.bad_groups)))
+    if repair:
+        click.echo('Repaired: {:,d} records deleted or groups changed'.format(rr.repaired))
+    sys.exit(1)
+
+
+def _fmt(v, fmt):
+    return '-' if v is None else fmt.format(v)
+
+
+@cli.command('bench')
+@click.option('--n', 'n', type=int, default=10000, help='Number of synthetic datasets')
+@click.option('--seed', type=int, default=0, help='Random seed for dataset generator')
+@click.option('--only', type=str, multiple=True, help='Run only this benchmark, can be repeated')
+@click.option('--workdir', type=str, help='Folder for temporary caches')
+@click.option('--output', '-o', type=str, help='Save results to this JSON file')
+@click.option('--baseline', type=str, help='Compare against results saved earlier')
+def bench(n, seed, only, workdir, output, baseline):
+    """Run benchmarks on synthetic datasets.
+    """
+    from dscache.tools.benchmark import (run_benchmarks, save_results,
+                                         load_results, compare_results)
+
+    rr = run_benchmarks(n=n, seed=seed, only=only, workdir=workdir,
+                        log=lambda name: click.echo('..' + name, err=True))
+
+    for name, r in rr['results'].items():
+        lat = r.get('latency_ms', {})
+        click.echo('{:22s} {:>12s}/s  p50:{:>9s}ms p99:{:>9s}ms  rss:{:,d}Mb {:>8s}'.format(
+            name,
+            _fmt(r['per_sec'], '{:,.0f}'),
+            _fmt(lat.get('p50'), '{:.3f}'),
+            _fmt(lat.get('p99'), '{:.3f}'),
+            r['peak_rss'] >> 20,
+            _fmt(None if r['rss_growth'] is None else r['rss_growth'] >> 20, '+{:,d}Mb')))
+
+    if output:
+        save_results(rr, output)
+
+    if baseline:
+        click.echo('\nCompared to {}:'.format(baseline))
+        for name, a, b, speedup, _, _ in compare_results(load_results(baseline), rr):
+            click.echo('{:22s} {:>12s} -> {:>12s}  x{}'.format(
+                name, _fmt(a, '{:,.0f}'), _fmt(b, '{:,.0f}'), _fmt(speedup, '{:.2f}')))
+
+
+if __name__ == '__main__':
+    cli()
@@ -1,6 +1,7 @@
 import click
 import dscache
-from dscache.tools.tiling import bin_dataset_stream, bin_by_native_tile, web_gs, extract_native_albers_tile
+from dscache.tools.tiling import (bin_dataset_stream_multi, bin_by_native_tile,
+                                  web_gs, extract_native_albers_tile)
 from datacube.model import GridSpec
 import datacube.utils.geometry as geom
 
@@ -10,45 +11,65 @@ GS_ALBERS = GridSpec(crs=geom.CRS('EPSG:3577'),
                      resolution=(-25, 25))
 
 
+def parse_zoom_levels(web):
+    """ Parse zoom level spec: ``N``, ``N-M`` or comma separated list of those
+    """
+    levels = []
+    for part in web.split(','):
+        lo, _, hi = part.partition('-')
+        levels.extend(range(int(lo), int(hi or lo) + 1))
+    return sorted(set(levels))
+
+
 @click.command('dstiler')
 @click.option('--native', is_flag=True, help='Use Landsat Path/Row as grouping')
 @click.option('--native-albers', is_flag=True, help='When datasets are in Albers grid already')
-@click.option('--web', type=int, help='Use web map tiling regime at supplied zoom level')
+@click.option('--web', type=str, help='Use web map tiling regime at supplied zoom level(s): N, N-M or N,M,...')
+@click.option('--albers', is_flag=True, help='Also group by Albers tiles when using --web')
 @click.argument('dbfile', type=str, nargs=1)
-def cli(native, native_albers, web, dbfile):
+def cli(native, native_albers, web, albers, dbfile):
     """Add spatial grouping to file db.
 
     Default grid is Australian Albers (EPSG:3577) with 100k by 100k tiles. But
     you can also group by Landsat path/row (--native), or Google's map tiling
     regime (--web zoom_level)
 
+    Several zoom levels (--web 5-12), optionally together with Albers tiles
+    (--albers), are computed in a single pass over the datasets.
+
+    For caches created with typed keys groups are named by tuples like
+    ('albers', x, y) or ('web_12', x, y), so they can be queried by range.
     """
     cache = dscache.open_rw(dbfile)
     label = 'Processing {} ({:,d} datasets)'.format(dbfile, cache.count)
 
     if native:
-        group_key_fmt = 'native/{:03d}{:03d}'
-        binner = bin_by_native_tile
+        binner = lambda dss: {'native/{:03d}{:03d}': bin_by_native_tile(dss, compact=True)}
     elif native_albers:
-        group_key_fmt = 'albers/{:+03d}{:+03d}'
-        binner = lambda dss: bin_by_native_tile(dss, native_tile_id=extract_native_albers_tile)
-    elif web is not None:
-        gs = web_gs(web)
-        group_key_fmt = 'web_' + str(web) + '/{:d}_{:d}'
-        binner = lambda dss: bin_dataset_stream(gs, dss)
+        binner = lambda dss: {'albers/{:+03d}{:+03d}': bin_by_native_tile(
+            dss, native_tile_id=extract_native_albers_tile, compact=True)}
     else:
-        group_key_fmt = 'albers/{:+03d}{:+03d}'
-        binner = lambda dss: bin_dataset_stream(GS_ALBERS, dss)
+        grids = {}
+        if web is None or albers:
+            grids['albers/{:+03d}{:+03d}'] = GS_ALBERS
+        if web is not None:
+            for zoom in parse_zoom_levels(web):
+                grids['web_' + str(zoom) + '/{:d}_{:d}'] = web_gs(zoom)
+        binner = lambda dss: bin_dataset_stream_multi(grids, dss, compact=True)
 
     with click.progressbar(cache.get_all(), length=cache.count, label=label) as dss:
-        bins = binner(dss)
+        all_bins = binner(dss)
 
-    click.echo('Total bins: {:d}'.format(len(bins)))
+    for group_key_fmt, bins in all_bins.items():
+        click.echo('Total bins ({}): {:d}'.format(group_key_fmt.split('/')[0], len(bins)))
 
-    with click.progressbar(bins.values(), length=len(bins), label='Saving') as groups:
-        for group in groups:
-            k = group_key_fmt.format(*group.idx)
-            cache.put_group(k, group.dss)
+        with click.progressbar(bins.values(), length=len(bins), label='Saving') as groups:
+            for group in groups:
+                if cache.typed_keys:
+                    k = (group_key_fmt.split('/')[0],) + tuple(group.idx)
+                else:
+                    k = group_key_fmt.format(*group.idx)
+                cache.put_group(k, group.dss)
 
 
 if __name__ == '__main__':
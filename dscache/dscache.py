@@ -5,10 +5,16 @@ import zstandard
 import operator
 import functools
 import itertools
+import threading
 import toolz
+from contextlib import contextmanager
+from time import perf_counter
 from types import SimpleNamespace
 from pathlib import Path
 from datacube.model import Dataset
+from .metrics import CacheStats
+from .keys import KEYFMT_VERSION, pack_key, unpack_key, box_scan
+from .intern import Interner
 
 FORMAT_VERSION = b'0001'
 
@@ -26,7 +32,7 @@ def key_to_bytes(k):
         elif k.bit_length() < 128:
             return k.to_bytes(16, 'big')
         else:
-            return str(k).decode('utf8')
+            return str(k).encode('utf8')
     if isinstance(k, tuple):
         return functools.reduce(operator.add, map(key_to_bytes, k))
 
@@ -34,6 +40,11 @@ def key_to_bytes(k):
 
 
 def uuids2bytes(uu):
+    if isinstance(uu, (bytes, bytearray, memoryview)):
+        if len(uu) & 0xF:
+            raise ValueError('Packed uuids must be a multiple of 16 bytes')
+        return bytes(uu)
+
     bb = bytearray(len(uu)*16)
     for i, u in enumerate(uu):
         bb[i*16:(i+1)*16] = u.bytes
@@ -79,18 +90,20 @@ def jsonKV2dict(kv, decompressor=None):
     return {k: doc for k, doc in map(decode, kv)}
 
 
-def ds2bytes(ds):
+def ds2bytes(ds, intern=None):
     k = key_to_bytes(ds.id)
 
     doc = dict(uris=ds.uris,
                product=ds.type.name,
                metadata=ds.metadata_doc)
+    if intern is not None:
+        doc = intern.pack(doc)
 
     d = json.dumps(doc, separators=(',', ':')).encode('utf8')
     return (k, d)
 
 
-def doc2bytes(raw_ds):
+def doc2bytes(raw_ds, intern=None):
     ''' raw_ds is
 
         metadata:
@@ -98,8 +111,12 @@ def doc2bytes(raw_ds):
           * other fields*
         uris: [<uri:string>]
         product: <string>
+
+    intern: Interner to store product and uri prefixes as references, optional
     '''
     k = UUID(toolz.get_in(['metadata', 'id'], raw_ds)).bytes
+    if intern is not None:
+        raw_ds = intern.pack(raw_ds)
     d = json.dumps(raw_ds, separators=(',', ':')).encode('utf8')
     return (k, d)
 
@@ -111,6 +128,61 @@ def doc2ds(doc, products):
     return Dataset(p, doc['metadata'], uris=doc['uris'])
 
 
+_TLS = threading.local()
+
+
+def _decompressor(zdict):
+    """ Decompressor objects are not thread safe, so keep one per thread and per dictionary.
+    """
+    cache = getattr(_TLS, 'decomp', None)
+    if cache is None:
+        cache = _TLS.decomp = {}
+
+    decomp = cache.get(zdict)
+    if decomp is None:
+        comp_params = {'dict_data': zstandard.ZstdCompressionDict(zdict)} if zdict else {}
+        decomp = cache[zdict] = zstandard.ZstdDecompressor(**comp_params)
+
+    return decomp
+
+
+def _decode_docs(zdict, batch, intern=None):
+    """ Decompress and parse a batch of records, safe to run in worker threads or processes.
+    """
+    decomp = _decompressor(zdict)
+    docs = [json.loads(decomp.decompress(d)) for d in batch]
+    if intern is not None:
+        docs = [intern.expand(doc) for doc in docs]
+    return docs
+
+
+def _decode_dss(zdict, products, batch, intern=None):
+    return [doc2ds(doc, products) for doc in _decode_docs(zdict, batch, intern)]
+
+
+_WORKER = {}
+
+
+def _worker_args(cache):
+    """ Picklable arguments for ``_init_decode_worker``: compression dictionary and product definitions
+    """
+    products = cache.products
+    metadata = {p.metadata_type.name: p.metadata_type.definition for p in products.values()}
+    return cache._zdict, metadata, toolz.valmap(lambda p: p.definition, products)
+
+
+def _init_decode_worker(zdict, metadata, products):
+    """ Process pool initializer, rebuilds product definitions in the worker process
+    """
+    _WORKER.update(zdict=zdict, products=build_dc_product_map(metadata, products))
+
+
+def _decode_worker(batch, intern=None):
+    """ Decode raw records into Datasets in a process set up by ``_init_decode_worker``
+    """
+    return _decode_dss(_WORKER['zdict'], _WORKER['products'], batch, intern)
+
+
 def save_products(products, transaction, compressor, overwrite=False):
     def get_metadata_definitions(products):
         mm = {}
@@ -165,16 +237,25 @@ class DatasetCache(object):
     info:
        version: 4-bytes
        zdict: pre-trained compression dictionary, optional
+       keyfmt: group name encoding, missing for plain (key_to_bytes),
+               KEYFMT_VERSION for typed order preserving keys (pack_key)
+       intern: json({version, uri_depth}), present when records are interned
+       intern/product/{id}, intern/uri/{id}: interned strings, see dscache.intern
        product/{name}: json
        metadata/{name}: json
 
     udata:
        arbitrary user data (TODO)
 
+    tombstones:
+       uuid: b'' -- deleted datasets that might still be listed in groups
+
     ds:
        uuid: compressed(json({product: str,
                               uris: [str],
                               metadata: object}))
+
+       or with interning: product is an id and uris are [[prefix_id, suffix]]
     """
     def __init__(self, state):
         """ Don't use this directly, use create_cache or open_cache.
@@ -183,10 +264,76 @@ class DatasetCache(object):
         self._dbs = state.dbs
         self._comp = state.comp
         self._decomp = state.decomp
+        self._zdict = state.zdict
+        self._keyfmt = state.keyfmt
+        self._intern = state.intern
         self._products = state.products
+        self._stats = None
+
+    _INSTRUMENTED = (('_extract_ds', '_extract_ds_timed'),
+                     ('_ds2kv', '_ds2kv_timed'),
+                     ('_doc2kv', '_doc2kv_timed'))
+
+    def enable_stats(self, stats=None):
+        """Start collecting metrics, returns CacheStats object that accumulates them.
+
+        :stats CacheStats: Use this object instead of creating a new one, allows
+        sharing stats across several caches.
+
+        Hot path methods are replaced with instrumented versions for this
+        instance, so there is no per-record cost while stats are disabled.
+        Paths that decode raw records outside of this instance
+        (``AsyncDatasetCache``, ``DcTileExtract.batch``, ``tools.partition``
+        and ``tools.export``) only report read transactions.
+        """
+        self._stats = CacheStats() if stats is None else stats
+        for name, timed in self._INSTRUMENTED:
+            setattr(self, name, getattr(self, timed))
+        return self._stats
+
+    def disable_stats(self):
+        for name, _ in self._INSTRUMENTED:
+            self.__dict__.pop(name, None)
+        self._stats = None
+
+    @property
+    def stats(self):
+        """ CacheStats object or None if stats collection is not enabled
+        """
+        return self._stats
+
+    @contextmanager
+    def _write_txn(self, db):
+        intern = self._intern
+        tr = self._dbs.main.begin(db, write=True)
+        try:
+            if intern is not None:
+                intern.load_committed(tr, self._dbs.info)
+            yield tr
+            if intern is not None:
+                intern.save(tr, self._dbs.info)
+        except BaseException:
+            tr.abort()
+            if intern is not None:
+                intern.rollback()
+            raise
+
+        t0 = perf_counter()
+        tr.commit()
+        if intern is not None:
+            intern.mark_saved()
+
+        if self._stats is not None:
+            self._stats.update(counters=dict(write_transactions=1),
+                               timers=dict(commit=perf_counter() - t0))
+
+    def _read_txn(self, db, buffers=False):
+        if self._stats is not None:
+            self._stats.inc('read_transactions')
+        return self._dbs.main.begin(db, write=False, buffers=buffers)
 
     def _store_products(self):
-        with self._dbs.main.begin(self._dbs.info, write=True) as tr:
+        with self._write_txn(self._dbs.info) as tr:
             save_products(self._products, tr, self._comp)
 
     def sync(self):
@@ -204,16 +351,60 @@ class DatasetCache(object):
     def products(self):
         return self._products
 
+    @property
+    def interned(self):
+        """ True when records store product names and uri prefixes as references
+        """
+        return self._intern is not None
+
+    @property
+    def typed_keys(self):
+        """ True when group names are stored with order preserving typed encoding
+        """
+        return self._keyfmt is not None
+
+    def _group_key(self, name, raw=False):
+        if raw:
+            if not isinstance(name, bytes):
+                raise ValueError('Raw group name must be bytes, as returned by groups(raw=True)')
+            return name
+        if self._keyfmt is None:
+            return key_to_bytes(name)
+        return pack_key(name)
+
+    def _group_name(self, k):
+        if self._keyfmt is None:
+            return k.decode('utf8')
+        name = unpack_key(k)
+        return name[0] if len(name) == 1 else name
+
     def _ds2kv(self, ds):
-        k, d = ds2bytes(ds)
+        k, d = ds2bytes(ds, self._intern)
         d = self._comp.compress(d)
         return (k, d)
 
     def _doc2kv(self, ds_raw):
-        k, d = doc2bytes(ds_raw)
+        k, d = doc2bytes(ds_raw, self._intern)
         d = self._comp.compress(d)
         return (k, d)
 
+    def _compress_timed(self, d):
+        t0 = perf_counter()
+        c = self._comp.compress(d)
+        self._stats.update(counters=dict(records_written=1,
+                                         bytes_compressed=len(d),
+                                         bytes_written=len(c)),
+                           timers=dict(compress=perf_counter() - t0))
+        return c
+
+    def _ds2kv_timed(self, ds):
+        k, d = ds2bytes(ds, self._intern)
+        return (k, self._compress_timed(d))
+
+    def _doc2kv_timed(self, ds_raw):
+        k, d = doc2bytes(ds_raw, self._intern)
+        return (k, self._compress_timed(d))
+
     def _ds_save(self, ds, transaction):
         if ds.type.name not in self._products:
             self._products[ds.type.name] = ds.type
@@ -222,7 +413,7 @@ class DatasetCache(object):
         transaction.put(k, v)
 
     def bulk_save(self, dss):
-        with self._dbs.main.begin(self._dbs.ds, write=True) as tr:
+        with self._write_txn(self._dbs.ds) as tr:
             for ds in dss:
                 self._ds_save(ds, tr)
 
@@ -235,7 +426,7 @@ class DatasetCache(object):
         have_some = True
 
         while have_some:
-            with self._dbs.main.begin(self._dbs.ds, write=True) as tr:
+            with self._write_txn(self._dbs.ds) as tr:
                 have_some = False
                 for ds in itertools.islice(dss, max_transaction_size):
                     have_some = True
@@ -245,30 +436,114 @@ class DatasetCache(object):
         self.sync()
 
     def bulk_save_raw(self, raw_dss):
-        with self._dbs.main.begin(self._dbs.ds, write=True) as tr:
+        with self._write_txn(self._dbs.ds) as tr:
             for raw_ds in raw_dss:
                 k, v = self._doc2kv(raw_ds)
                 tr.put(k, v)
 
-    def put_group(self, name, uuids):
+    def delete(self, uuid):
+        """ Remove dataset with a given uuid, returns True if it was present
+        """
+        return self.bulk_delete([uuid]) == 1
+
+    def bulk_delete(self, uuids, max_transaction_size=10000):
+        """Remove datasets with given uuids, returns number of datasets that were present.
+
+        Groups are not rewritten, instead deleted datasets are recorded in a
+        tombstone set, group readers skip deleted members and ``groups()``
+        sizes include them until ``compact_groups`` is called.
+
+        :max_transaction_size int: How often to commit results to disk
+        """
+        dbs = self._dbs
+        keys = (key_to_bytes(UUID(u) if isinstance(u, str) else u) for u in uuids)
+        n = 0
+
+        for chunk in toolz.partition_all(max_transaction_size, keys):
+            with self._write_txn(dbs.ds) as tr:
+                for k in chunk:
+                    if tr.delete(k):
+                        tr.put(k, b'', db=dbs.tombstones)
+                        n += 1
+        return n
+
+    def compact_groups(self):
+        """Remove deleted datasets from all groups and clear the tombstone set.
+        Tombstoned datasets that were added again since are kept in groups.
+
+        Returns SimpleNamespace(groups, members, tombstones): number of groups
+        rewritten, members removed and tombstones cleared.
+        """
+        dbs = self._dbs
+        out = SimpleNamespace(groups=0, members=0, tombstones=0)
+        if dbs.tombstones is None:
+            return out
+
+        with self._write_txn(dbs.groups) as tr:
+            out.tombstones = tr.stat(dbs.tombstones)['entries']
+            if out.tombstones == 0:
+                return out
+
+            dead = {bytes(k) for k, _ in tr.cursor(db=dbs.tombstones)
+                    if tr.get(k, db=dbs.ds) is None}
+
+            cursor = tr.cursor()
+            for name, data in cursor:
+                keep = [data[i:i+16] for i in range(0, len(data), 16)]
+                keep = [k for k in keep if k not in dead]
+                keep = b''.join(keep)
+                if len(keep) != len(data):
+                    cursor.put(name, keep)
+                    out.groups += 1
+                    out.members += (len(data) - len(keep))//16
+
+            tr.drop(dbs.tombstones, delete=False)
+
+        return out
+
+    def put_group(self, name, uuids, raw=False):
         """ Group is a named list of uuids
+
+        :uuids: Sequence of UUIDs, or bytes-like object of concatenated 16 byte keys
+        :raw bool: Name is an encoded key as returned by ``groups(raw=True)``
         """
         data = uuids2bytes(uuids)
-        k = key_to_bytes(name)
+        k = self._group_key(name, raw)
 
-        with self._dbs.main.begin(self._dbs.groups, write=True) as tr:
+        with self._write_txn(self._dbs.groups) as tr:
             tr.put(k, data)
 
-    def _get_group_raw(self, name):
-        k = key_to_bytes(name)
+    def _get_group_raw(self, name, raw=False):
+        k = self._group_key(name, raw)
+
+        with self._read_txn(self._dbs.groups) as tr:
+            data = tr.get(k)
+            return None if data is None else self._drop_deleted(tr, data)
 
-        with self._dbs.main.begin(self._dbs.groups, write=False) as tr:
-            return tr.get(k)
+    def _get_groups_raw(self, names):
+        """ Like ``_get_group_raw`` for many groups within one read transaction
+        """
+        with self._read_txn(self._dbs.groups) as tr:
+            out = [tr.get(self._group_key(name)) for name in names]
+            return [None if data is None else self._drop_deleted(tr, data) for data in out]
 
-    def get_group(self, name):
+    def _drop_deleted(self, tr, data):
+        """ Remove group members that were deleted but not yet compacted out of the group
+        """
+        ts, ds = self._dbs.tombstones, self._dbs.ds
+        if ts is None or tr.stat(ts)['entries'] == 0:
+            return data
+
+        keep = [data[i:i+16] for i in range(0, len(data), 16)]
+        keep = [k for k in keep if tr.get(k, db=ts) is None or tr.get(k, db=ds) is not None]
+        return b''.join(keep)
+
+    def get_group(self, name, raw=False):
         """ Group is a named list of uuids
+
+        :raw bool: Name is an encoded key as returned by ``groups(raw=True)``
         """
-        data = self._get_group_raw(key_to_bytes(name))
+        data = self._get_group_raw(name, raw)
         return bytes2uuids(data) if data is not None else None
 
     def groups(self, raw=False, prefix=None):
@@ -278,27 +553,105 @@ class DatasetCache(object):
         would return bytes instead, this is needed if you are using group names
         that are not strings, like integers or tuples of basic types.
 
-        :prefix str|bytes: Only report groups with name starting with prefix
+        Sizes include members deleted since the last ``compact_groups``.
+
+        :prefix str|bytes|tuple: Only report groups with name starting with
+        prefix. With typed keys a tuple prefix matches names that start with
+        these elements, and a str prefix matches names whose first element
+        starts with that string. A bytes prefix is matched against encoded
+        names as returned with raw=True.
         """
 
-        assert isinstance(prefix, (str, bytes, type(None)))
+        assert isinstance(prefix, (str, bytes, tuple, type(None)))
 
         def _raw(prefix):
-            with self._dbs.main.begin(self._dbs.groups, write=False, buffers=True) as tr:
+            with self._read_txn(self._dbs.groups, buffers=True) as tr:
                 cursor = tr.cursor() if prefix is None else prefix_visit(tr, prefix, full_key=True)
                 return [(bytes(k), len(d)//16) for k, d in cursor]
 
-        if prefix is not None:
-            prefix = key_to_bytes(prefix)
+        if isinstance(prefix, str) and self._keyfmt is not None:
+            prefix = pack_key(prefix)[:-1]  # drop string terminator
+        elif prefix is not None:
+            prefix = self._group_key(prefix, raw=isinstance(prefix, bytes))
 
         nn = _raw(prefix)
-        return nn if raw else [(n.decode('utf8'), c) for n, c in nn]
+        return nn if raw else [(self._group_name(n), c) for n, c in nn]
+
+    def group_range(self, start=None, stop=None, raw=False):
+        """Get list of (group_name, group_size) for groups with start <= name < stop
+        in key order. With typed keys this is the natural order of names,
+        so ``group_range(('albers', 10), ('albers', 21))`` is every albers tile
+        with x in [10, 20].
+        """
+        stop = None if stop is None else self._group_key(stop)
+
+        out = []
+        with self._read_txn(self._dbs.groups, buffers=True) as tr:
+            cursor = tr.cursor()
+            ok = cursor.first() if start is None else cursor.set_range(self._group_key(start))
+            while ok:
+                k = bytes(cursor.key())
+                if stop is not None and k >= stop:
+                    break
+                out.append((k, len(cursor.value())//16))
+                ok = cursor.next()
+
+        return out if raw else [(self._group_name(n), c) for n, c in out]
+
+    def groups_in_box(self, prefix, ranges, raw=False):
+        """Get list of (group_name, group_size) for groups named ``prefix + (v1, v2, ...)``
+        with every ``lo_i <= v_i <= hi_i``, e.g. albers tiles with x in
+        [10, 20] and y in [-40, -30]::
+
+           cache.groups_in_box('albers', [(10, 20), (-40, -30)])
+
+        Implemented as a skip scan, cost is proportional to the number of
+        matching groups plus one seek per out of range run, rather than to the
+        total number of groups. Requires a cache created with ``typed_keys=True``.
+
+        :prefix: Leading element(s) of group names, str or tuple
+        :ranges: [(lo, hi)] inclusive bounds, one per name element following the prefix
+        """
+        if self._keyfmt is None:
+            raise ValueError('Range queries require a cache with typed group keys')
+        if len(ranges) == 0:
+            raise ValueError('Need at least one range')
+
+        prefix = pack_key(prefix)
+        ranges = [(pack_key(lo), pack_key(hi)) for lo, hi in ranges]
+
+        with self._read_txn(self._dbs.groups, buffers=True) as tr:
+            out = [(k, len(d)//16) for k, d in box_scan(tr.cursor(), prefix, ranges)]
+
+        return out if raw else [(self._group_name(n), c) for n, c in out]
 
     def _extract_ds(self, d):
         d = self._decomp.decompress(d)
         doc = json.loads(d)
+        if self._intern is not None:
+            self._intern.expand(doc)
         return doc2ds(doc, self._products)
 
+    def _extract_ds_timed(self, d):
+        n_in = len(d)
+        t0 = perf_counter()
+        d = self._decomp.decompress(d)
+        t1 = perf_counter()
+        doc = json.loads(d)
+        if self._intern is not None:
+            self._intern.expand(doc)
+        t2 = perf_counter()
+        ds = doc2ds(doc, self._products)
+        t3 = perf_counter()
+
+        self._stats.update(counters=dict(records_read=1,
+                                         bytes_read=n_in,
+                                         bytes_decompressed=len(d)),
+                           timers=dict(decompress=t1 - t0,
+                                       json_parse=t2 - t1,
+                                       dataset_construct=t3 - t2))
+        return ds
+
     def get(self, uuid):
         """Extract single dataset with a given uuid, or return None if not found"""
         if isinstance(uuid, str):
@@ -306,38 +659,109 @@ class DatasetCache(object):
 
         key = key_to_bytes(uuid)
 
-        with self._dbs.main.begin(self._dbs.ds, buffers=True) as tr:
+        with self._read_txn(self._dbs.ds, buffers=True) as tr:
             d = tr.get(key, None)
             if d is None:
                 return None
 
             return self._extract_ds(d)
 
-    def get_all(self):
-        with self._dbs.main.begin(self._dbs.ds, buffers=True) as tr:
-            for _, d in tr.cursor():
+    def get_all(self, start=None, stop=None):
+        """Iterate over datasets in key order.
+
+        :start bytes|UUID: Only report datasets with key >= start
+        :stop bytes|UUID: Only report datasets with key < stop
+        """
+        if stop is not None:
+            stop = key_to_bytes(stop)
+
+        with self._read_txn(self._dbs.ds, buffers=True) as tr:
+            cursor = tr.cursor()
+            if start is not None and not cursor.set_range(key_to_bytes(start)):
+                return
+
+            for k, d in cursor:
+                if stop is not None and bytes(k) >= stop:
+                    break
                 yield self._extract_ds(d)
 
-    def stream_group(self, group_name):
-        uu = self._get_group_raw(group_name)
+    def _get_raw_many(self, keys):
+        """Fetch compressed records for a sequence of 16 byte keys within one short
+        read transaction. Returns list of bytes, with None for missing keys.
+        """
+        with self._read_txn(self._dbs.ds) as tr:
+            return [tr.get(k, None) for k in keys]
+
+    def _tombstoned(self, keys):
+        """ Subset of 16 byte keys that were deleted since last ``compact_groups``
+        """
+        ts = self._dbs.tombstones
+        if ts is None:
+            return set()
+        with self._read_txn(ts) as tr:
+            return {bytes(k) for k in keys if tr.get(k) is not None}
+
+    def _scan_raw(self, pos=None, limit=1000):
+        """Read up to `limit` compressed records in key order, starting after
+        position `pos` (None means start from the beginning). Transaction is
+        closed before returning.
+
+        Returns tuple (records, pos), where pos is None once there is no more data.
+        """
+        out = []
+        with self._read_txn(self._dbs.ds) as tr:
+            cursor = tr.cursor()
+            ok = cursor.first() if pos is None else cursor.set_range(pos)
+            if ok and pos is not None and cursor.key() == pos:
+                ok = cursor.next()
+
+            while ok and len(out) < limit:
+                out.append(cursor.value())
+                pos = cursor.key()
+                ok = cursor.next()
+
+        return out, (pos if ok else None)
+
+    def stream_group(self, group_name, raw=False):
+        if self._stats is None:
+            return self._stream_group(group_name, raw)
+        return self._stream_group_timed(group_name, raw)
+
+    def _stream_group_timed(self, group_name, raw=False):
+        # Only time spent producing datasets is counted, not the time consumer
+        # takes between them
+        n, elapsed = 0, 0.0
+        t0 = perf_counter()
+        for ds in self._stream_group(group_name, raw):
+            elapsed += perf_counter() - t0
+            n += 1
+            yield ds
+            t0 = perf_counter()
+        elapsed += perf_counter() - t0
+        self._stats.observe_group(group_name, n, elapsed)
+
+    def _stream_group(self, group_name, raw=False):
+        uu = self._get_group_raw(group_name, raw)
         if uu is None:
-            raise ValueError('No such group: %s' % group_name)
+            raise ValueError('No such group: %s' % (group_name,))
 
         if len(uu) & 0xF:
-            raise ValueError('Wrong data size for group %s' % group_name)
+            raise ValueError('Wrong data size for group %s' % (group_name,))
 
-        with self._dbs.main.begin(self._dbs.ds, buffers=True) as tr:
+        with self._read_txn(self._dbs.ds, buffers=True) as tr:
             for i in range(0, len(uu), 16):
                 key = uu[i:i+16]
                 d = tr.get(key, None)
                 if d is None:
+                    if self._dbs.tombstones is not None and tr.get(key, db=self._dbs.tombstones) is not None:
+                        continue  # deleted after group was read
                     raise ValueError('Missing dataset for %s' % (str(UUID(bytes=key))))
 
                 yield self._extract_ds(d)
 
     @property
     def count(self):
-        with self._dbs.main.begin(self._dbs.ds) as tr:
+        with self._read_txn(self._dbs.ds) as tr:
             return tr.stat()['entries']
 
 
@@ -362,6 +786,16 @@ def maybe_delete_db(path):
     return True
 
 
+def _open_tombstones(db, readonly):
+    """ Caches created before deletes were supported have no tombstones db,
+    it is created on first writable open, and is None for readonly opens.
+    """
+    try:
+        return db.open_db(b'tombstones', create=not readonly)
+    except lmdb.NotFoundError:
+        return None
+
+
 def _from_existing_db(db, products=None, complevel=6):
     readonly = db.flags().get('readonly')
 
@@ -378,12 +812,20 @@ def _from_existing_db(db, products=None, complevel=6):
             raise ValueError("Unsupported on disk version: " + version.decode('utf8'))
 
         zdict = tr.get(b'zdict', None)
+        keyfmt = tr.get(b'keyfmt', None)
+        if keyfmt not in (None, KEYFMT_VERSION):
+            raise ValueError("Unsupported key format: " + keyfmt.decode('utf8'))
+
+        intern = Interner.load(tr, db_info)
+        if intern is not None:
+            intern.attach(db, db_info)
 
     dbs = SimpleNamespace(main=db,
                           info=db_info,
                           groups=db.open_db(b'groups', create=False),
                           ds=db.open_db(b'ds', create=False),
-                          udata=db.open_db(b'udata', create=False))
+                          udata=db.open_db(b'udata', create=False),
+                          tombstones=_open_tombstones(db, readonly))
 
     comp_params = {'dict_data': zstandard.ZstdCompressionDict(zdict)} if zdict else {}
 
@@ -400,6 +842,9 @@ def _from_existing_db(db, products=None, complevel=6):
     state = SimpleNamespace(dbs=dbs,
                             comp=comp,
                             decomp=decomp,
+                            zdict=zdict,
+                            keyfmt=keyfmt,
+                            intern=intern,
                             products=products)
 
     return DatasetCache(state)
@@ -407,7 +852,9 @@ def _from_existing_db(db, products=None, complevel=6):
 
 def _from_empty_db(db,
                    complevel=6,
-                   zdict=None):
+                   zdict=None,
+                   typed_keys=False,
+                   intern=None):
     assert isinstance(zdict, (bytes, type(None)))
 
     db_info = db.open_db(b'info', create=True)
@@ -418,11 +865,21 @@ def _from_empty_db(db,
         if zdict is not None:
             tr.put(b'zdict', zdict)
 
+        if typed_keys:
+            tr.put(b'keyfmt', KEYFMT_VERSION)
+
+        if intern is not None:
+            intern.store_config(tr, db_info)
+
+    if intern is not None:
+        intern.attach(db, db_info)
+
     dbs = SimpleNamespace(main=db,
                           info=db_info,
                           groups=db.open_db(b'groups', create=True),
                           ds=db.open_db(b'ds', create=True),
-                          udata=db.open_db(b'udata', create=True))
+                          udata=db.open_db(b'udata', create=True),
+                          tombstones=db.open_db(b'tombstones', create=True))
 
     comp_params = {'dict_data': zstandard.ZstdCompressionDict(zdict)} if zdict else {}
 
@@ -432,6 +889,9 @@ def _from_empty_db(db,
     state = SimpleNamespace(dbs=dbs,
                             comp=comp,
                             decomp=decomp,
+                            zdict=zdict,
+                            keyfmt=KEYFMT_VERSION if typed_keys else None,
+                            intern=intern,
                             products={})
 
     return DatasetCache(state)
@@ -454,7 +914,12 @@ def open_ro(path,
 
     :lock bool: Supply True if external process is changing DB concurrently.
 
+    Sharded caches (folder with a manifest) are opened with all available shards.
     """
+    from .sharded import is_sharded, open_sharded
+
+    if is_sharded(path):
+        return open_sharded(path, readonly=True, products=products, lock=lock)
 
     subdir = Path(path).is_dir()
 
@@ -485,7 +950,14 @@ def open_rw(path,
 
     :complevel: Compression level (Zstandard) to use when storing datasets, 1
     fastest, 6 good and still fast, 20+ best but slower.
+
+    Sharded caches (folder with a manifest) are opened with all shards.
     """
+    from .sharded import is_sharded, open_sharded
+
+    if is_sharded(path):
+        return open_sharded(path, readonly=False, products=products,
+                            max_db_sz=max_db_sz, complevel=complevel)
 
     subdir = Path(path).is_dir()
 
@@ -507,8 +979,22 @@ def create_cache(path,
                  complevel=6,
                  zdict=None,
                  max_db_sz=None,
-                 truncate=False):
-    """
+                 truncate=False,
+                 typed_keys=False,
+                 intern=False,
+                 intern_uri_depth=2):
+    """Create new cache, or open existing one in append mode.
+
+    :typed_keys bool: Store group names with order preserving typed encoding
+    (see ``dscache.keys.pack_key``), names can then be str, int, UUID or
+    tuples of those, and groups can be queried by range with
+    ``group_range`` and ``groups_in_box``. Ignored for existing caches.
+
+    :intern bool: Store product names and uri prefixes once in a table and
+    only keep references to them in records (see ``dscache.intern``), this
+    is transparent to readers. Ignored for existing caches.
+
+    :intern_uri_depth int: Uri prefix is scheme, host and this many path components
     """
 
     if truncate:
@@ -527,12 +1013,13 @@ def create_cache(path,
     if db.stat()['entries'] > 0:
         return _from_existing_db(db, complevel=complevel)
     else:
-        return _from_empty_db(db, complevel=complevel, zdict=zdict)
+        return _from_empty_db(db, complevel=complevel, zdict=zdict, typed_keys=typed_keys,
+                              intern=Interner(intern_uri_depth) if intern else None)
 
 
 def test_key_to_value():
 
-    for k in ("string", 217987, 215781587158712587, ("AAA", 3)):
+    for k in ("string", 217987, 215781587158712587, 1 << 200, ("AAA", 3)):
         bb = key_to_bytes(k)
         assert isinstance(bb, bytes)
 
@@ -546,3 +1033,109 @@ def test_create_cache():
     del ss
     ss = open_ro('tmp.lmdb')
     print(ss)
+
+
+def test_typed_keys():
+    kk = [-(1 << 100), -70000, -256, -255, -1, 0, 1, 255, 256, 70000, 1 << 100,
+          'a', 'a\x00', 'ab', 'b', ('a', -1), ('a', 0), ('a', 0, 'x'), ('a', 1), ('b', -5)]
+    for k in kk:
+        assert unpack_key(pack_key(k)) == (k if isinstance(k, tuple) else (k,))
+
+    ints = [k for k in kk if isinstance(k, int)]
+    assert sorted(ints, key=pack_key) == ints
+
+    tt = [k for k in kk if isinstance(k, tuple)]
+    assert sorted(tt, key=pack_key) == tt
+
+
+def test_typed_group_names(tmp_path):
+    from .tools.synthetic import gen_datasets
+
+    dss = list(gen_datasets(4))
+    ids = [ds.id for ds in dss]
+    cache = create_cache(str(tmp_path/'t.db'), typed_keys=True)
+    cache.bulk_save(dss)
+    cache.put_group(b'\xff\x00', ids[:1])
+    cache.put_group(('a', b'b', 1), ids[1:3])
+    cache.put_group('c', ids)
+
+    assert cache.groups() == [(b'\xff\x00', 1), (('a', b'b', 1), 2), ('c', 4)]
+    assert cache.get_group(b'\xff\x00') == ids[:1]
+
+    for name, n in cache.groups(raw=True):
+        assert len(cache.get_group(name, raw=True)) == n
+        assert len(list(cache.stream_group(name, raw=True))) == n
+        assert cache.get_group(name) is None
+
+    cache.put_group(pack_key('c'), ids[:2], raw=True)
+    assert cache.get_group('c') == ids[:2]
+
+
+def test_intern():
+    intern = Interner(uri_depth=1)
+    doc = dict(product='ls8', uris=['s3://b/ls8/a/x.yaml', 'file:///g/data/y.yaml'], metadata={})
+    packed = intern.pack(doc)
+    assert packed['product'] == 0
+    assert packed['uris'] == [[0, 'a/x.yaml'], [1, 'data/y.yaml']]
+    assert intern.expand(json.loads(json.dumps(packed))) == doc
+
+
+def test_delete(tmp_path):
+    from .tools.synthetic import gen_datasets
+
+    dss = list(gen_datasets(10))
+    cache = create_cache(str(tmp_path/'d.db'))
+    cache.bulk_save(dss)
+    cache.put_group('g', [ds.id for ds in dss])
+
+    assert cache.bulk_delete([ds.id for ds in dss[:3]] + [dss[0].id]) == 3
+    assert cache.delete(str(dss[3].id)) is True
+    assert cache.delete(dss[3].id) is False
+    assert cache.count == 6
+    assert cache.get_group('g') == [ds.id for ds in dss[4:]]
+    assert [ds.id for ds in cache.stream_group('g')] == [ds.id for ds in dss[4:]]
+    assert cache.groups() == [('g', 10)]
+
+    cache.bulk_save(dss[:1])
+    assert cache.get_group('g') == [dss[0].id] + [ds.id for ds in dss[4:]]
+
+    rr = cache.compact_groups()
+    assert (rr.groups, rr.members, rr.tombstones) == (1, 3, 4)
+    assert cache.groups() == [('g', 7)]
+    assert cache.compact_groups().tombstones == 0
+
+
+def test_intern_two_writers(tmp_path):
+    from .tools.synthetic import gen_datasets
+
+    dss = list(gen_datasets(200))
+    a = create_cache(str(tmp_path/'i.db'), intern=True)
+    a.bulk_save(dss[:10])
+    a.sync()
+
+    # second writer on the same environment, as a writer in another process would see it
+    b = _from_existing_db(a._dbs.main)
+    a.bulk_save(dss[10:100])
+    b.bulk_save(dss[100:])
+
+    expect = {ds.id: ds.uris for ds in dss}
+    for cache in (a, b):
+        assert {ds.id: ds.uris for ds in cache.get_all()} == expect
+
+
+def test_intern_reload(tmp_path):
+    from .tools.synthetic import gen_datasets
+
+    dss = list(gen_datasets(200))
+    writer = create_cache(str(tmp_path/'i.db'), intern=True)
+    writer.bulk_save(dss[:5])
+    writer.sync()
+
+    # second instance on the same environment, as a reader in another process would see it
+    reader = _from_existing_db(writer._dbs.main)
+    n = len(reader._intern.prefixes)
+
+    writer.bulk_save(dss[5:])
+    assert len(writer._intern.prefixes) > n
+    assert [ds.uris for ds in reader.get_all()] == [ds.uris for ds in sorted(dss, key=lambda ds: ds.id.bytes)]
+    assert len(reader._intern.prefixes) == len(writer._intern.prefixes)
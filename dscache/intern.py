@@ -0,0 +1,222 @@
+""" Interning of product names and URI prefixes in stored records
+
+Interned records look like::
+
+   {product: <int>, uris: [[<int>, suffix: str]], metadata: object}
+
+where integers refer to entries of per cache string tables kept in the info
+db under ``intern/product/{id}`` and ``intern/uri/{id}``, with ids as 4 byte
+big endian integers. New entries are written in the same transaction as the
+records that first use them.
+
+Readers of a cache that is being written by another process load entries
+added since the cache was opened on first use of an unknown id.
+"""
+import json
+import threading
+
+INTERN_VERSION = 1
+
+
+class InternTable(object):
+    """ Append only list of strings with reverse lookup
+    """
+
+    def __init__(self, strings=None):
+        self.strings = list(strings or [])
+        self._ids = {s: i for i, s in enumerate(self.strings)}
+        self._saved = len(self.strings)
+
+    def __len__(self):
+        return len(self.strings)
+
+    def intern(self, s):
+        i = self._ids.get(s)
+        if i is None:
+            i = self._ids[s] = len(self.strings)
+            self.strings.append(s)
+        return i
+
+    def pending(self):
+        """ (id, string) pairs added since last ``mark_saved``
+        """
+        return list(enumerate(self.strings[self._saved:], self._saved))
+
+    def mark_saved(self):
+        self._saved = len(self.strings)
+
+    def has_pending(self):
+        return self._saved < len(self.strings)
+
+    def append_saved(self, s):
+        """ Add entry that is already stored on disk
+        """
+        self.intern(s)
+        self._saved = len(self.strings)
+
+    def rollback(self):
+        """ Forget entries added since last ``mark_saved``
+        """
+        for s in self.strings[self._saved:]:
+            del self._ids[s]
+        del self.strings[self._saved:]
+
+
+def split_uri(uri, depth):
+    """Split uri into prefix and suffix, prefix is scheme and host followed by
+    at most ``depth`` path components.
+
+    ``s3://bucket/a/b/c/x.yaml``, depth=2 -> ``s3://bucket/a/b/``, ``c/x.yaml``
+    """
+    i = uri.find('://')
+    i = 0 if i < 0 else i + 3
+    for _ in range(depth + 1):
+        j = uri.find('/', i)
+        if j < 0:
+            break
+        i = j + 1
+    return uri[:i], uri[i:]
+
+
+def _entry_key(name, i):
+    return 'intern/{}/'.format(name).encode('utf8') + i.to_bytes(4, 'big')
+
+
+class Interner(object):
+    """ Converts records between full and interned forms
+    """
+
+    def __init__(self, uri_depth=2, products=None, prefixes=None):
+        self.uri_depth = uri_depth
+        self.products = InternTable(products)
+        self.prefixes = InternTable(prefixes)
+        self._source = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Tables only, environment handles can not be sent to other processes
+        state = dict(self.__dict__)
+        state.update(_source=None, _lock=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def attach(self, env, db):
+        """ Remember where tables are stored, so that ``refresh`` can load new entries
+        """
+        self._source = (env, db)
+
+    def refresh(self):
+        """Load entries added to the info db (possibly by another process) since
+        tables were loaded. Returns number of new entries.
+        """
+        if self._source is None:
+            return 0
+
+        env, db = self._source
+        with self._lock, env.begin(db, write=False) as tr:
+            return self._load_new(tr, db)
+
+    def load_committed(self, transaction, db):
+        """Load entries committed by other writers, call at the start of every
+        write transaction so that new ids never collide with theirs.
+        """
+        with self._lock:
+            return self._load_new(transaction, db)
+
+    def _load_new(self, transaction, db):
+        n = 0
+        for name, table in (('product', self.products), ('uri', self.prefixes)):
+            if table.has_pending():
+                continue  # this instance is the writer, nothing to load
+            while True:
+                s = transaction.get(_entry_key(name, len(table)), db=db)
+                if s is None:
+                    break
+                table.append_saved(bytes(s).decode('utf8'))
+                n += 1
+        return n
+
+    @property
+    def config(self):
+        return dict(version=INTERN_VERSION, uri_depth=self.uri_depth)
+
+    def pack(self, doc):
+        """ Full record -> interned record
+        """
+        intern = self.prefixes.intern
+        uris = []
+        for uri in doc['uris']:
+            prefix, suffix = split_uri(uri, self.uri_depth)
+            uris.append([intern(prefix), suffix])
+
+        return dict(uris=uris,
+                    product=self.products.intern(doc['product']),
+                    metadata=doc['metadata'])
+
+    def _lookup(self, doc):
+        prefixes = self.prefixes.strings
+        return (self.products.strings[doc['product']],
+                [prefixes[i] + suffix for i, suffix in doc['uris']])
+
+    def expand(self, doc):
+        """ Interned record -> full record, modifies ``doc`` in place and returns it
+        """
+        if not isinstance(doc['product'], int):
+            return doc
+
+        try:
+            product, uris = self._lookup(doc)
+        except IndexError:
+            if self.refresh() == 0:
+                raise ValueError('Record refers to unknown interned string')
+            product, uris = self._lookup(doc)
+
+        doc['product'] = product
+        doc['uris'] = uris
+        return doc
+
+    def save(self, transaction, db):
+        """ Write new table entries, call from the transaction that writes records using them
+        """
+        for name, table in (('product', self.products), ('uri', self.prefixes)):
+            for i, s in table.pending():
+                if not transaction.put(_entry_key(name, i), s.encode('utf8'), db=db, overwrite=False):
+                    raise ValueError('Interned {} id {:d} is already taken'.format(name, i))
+
+    def mark_saved(self):
+        self.products.mark_saved()
+        self.prefixes.mark_saved()
+
+    def rollback(self):
+        self.products.rollback()
+        self.prefixes.rollback()
+
+    def store_config(self, transaction, db):
+        transaction.put(b'intern', json.dumps(self.config).encode('utf8'), db=db)
+
+    @staticmethod
+    def load(transaction, db):
+        """ Load interning tables, returns None if cache is not using interning
+        """
+        cfg = transaction.get(b'intern', None, db=db)
+        if cfg is None:
+            return None
+
+        cfg = json.loads(bytes(cfg))
+        if cfg.get('version') != INTERN_VERSION:
+            raise ValueError('Unsupported intern table version: {}'.format(cfg.get('version')))
+
+        def strings(name):
+            prefix = 'intern/{}/'.format(name).encode('utf8')
+            cursor = transaction.cursor(db=db)
+            out = []
+            ok = cursor.set_range(prefix)
+            while ok and bytes(cursor.key()).startswith(prefix):
+                out.append(bytes(cursor.value()).decode('utf8'))
+                ok = cursor.next()
+            return out
+
+        return Interner(cfg['uri_depth'], products=strings('product'), prefixes=strings('uri'))
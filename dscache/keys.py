@@ -0,0 +1,193 @@
+""" Order preserving encoding of typed keys
+
+Encoding is a subset of the FoundationDB tuple layer: every element starts
+with a type code followed by a self-delimiting payload, so that byte order of
+encoded keys matches natural order of the values (ints numerically, strings
+and bytes lexicographically, tuples element by element, shorter tuple first).
+
+Top level tuple is a concatenation of its encoded elements, hence encoding of
+a tuple is a byte prefix of the encoding of any longer tuple that starts with
+it, which is what makes prefix and range scans work.
+"""
+from uuid import UUID
+
+KEYFMT_VERSION = b'1'
+
+_NIL = 0x00
+_BYTES = 0x01
+_STR = 0x02
+_NESTED = 0x05
+_NEG_BIG = 0x0b
+_INT_ZERO = 0x14
+_POS_BIG = 0x1d
+_UUID = 0x30
+
+
+def _escape(b):
+    return b.replace(b'\x00', b'\x00\xff') + b'\x00'
+
+
+def _encode(v, out):
+    if isinstance(v, str):
+        out.append(_STR)
+        out += _escape(v.encode('utf8'))
+    elif isinstance(v, bytes):
+        out.append(_BYTES)
+        out += _escape(v)
+    elif isinstance(v, int):
+        if v == 0:
+            out.append(_INT_ZERO)
+            return
+        n = (abs(v).bit_length() + 7)//8
+        if n > 255:
+            raise ValueError('Integer key is too large')
+        if v > 0:
+            if n <= 8:
+                out.append(_INT_ZERO + n)
+            else:
+                out += bytes([_POS_BIG, n])
+            out += v.to_bytes(n, 'big')
+        else:
+            if n <= 8:
+                out.append(_INT_ZERO - n)
+            else:
+                out += bytes([_NEG_BIG, n ^ 0xff])
+            out += (v + (1 << (8*n)) - 1).to_bytes(n, 'big')
+    elif isinstance(v, UUID):
+        out.append(_UUID)
+        out += v.bytes
+    elif isinstance(v, tuple):
+        out.append(_NESTED)
+        for x in v:
+            _encode(x, out)
+        out.append(_NIL)
+    else:
+        raise ValueError('Key must be one of str|bytes|int|UUID|tuple')
+
+
+def _unescape(b, i):
+    """ Returns (payload, index past the terminator)
+    """
+    out = bytearray()
+    while True:
+        end = b.index(b'\x00', i)
+        out += b[i:end]
+        if end + 1 < len(b) and b[end + 1] == 0xff:
+            out.append(0)
+            i = end + 2
+        else:
+            return bytes(out), end + 1
+
+
+def _decode(b, i):
+    """ Decode one element starting at ``b[i]``, returns (value, next index)
+    """
+    code = b[i]
+    i += 1
+
+    if code == _STR:
+        v, i = _unescape(b, i)
+        return v.decode('utf8'), i
+    if code == _BYTES:
+        return _unescape(b, i)
+    if code == _INT_ZERO:
+        return 0, i
+    if _INT_ZERO < code <= _INT_ZERO + 8:
+        n = code - _INT_ZERO
+        return int.from_bytes(b[i:i+n], 'big'), i + n
+    if _INT_ZERO - 8 <= code < _INT_ZERO:
+        n = _INT_ZERO - code
+        return int.from_bytes(b[i:i+n], 'big') - (1 << (8*n)) + 1, i + n
+    if code == _POS_BIG:
+        n = b[i]
+        return int.from_bytes(b[i+1:i+1+n], 'big'), i + 1 + n
+    if code == _NEG_BIG:
+        n = b[i] ^ 0xff
+        return int.from_bytes(b[i+1:i+1+n], 'big') - (1 << (8*n)) + 1, i + 1 + n
+    if code == _UUID:
+        return UUID(bytes=bytes(b[i:i+16])), i + 16
+    if code == _NESTED:
+        vv = []
+        while b[i] != _NIL:
+            v, i = _decode(b, i)
+            vv.append(v)
+        return tuple(vv), i + 1
+
+    raise ValueError('Unknown type code in key: 0x{:02x}'.format(code))
+
+
+def pack_key(k):
+    """Encode str|bytes|int|UUID or a tuple of those (possibly nested) into
+    bytes that sort in the same order as the values.
+
+    Single value and a tuple of one element have the same encoding.
+    """
+    out = bytearray()
+    for v in (k if isinstance(k, tuple) else (k,)):
+        _encode(v, out)
+    return bytes(out)
+
+
+def unpack_key(b):
+    """ Inverse of pack_key, always returns a tuple
+    """
+    return tuple(v for v, _ in iter_elements(b))
+
+
+def iter_elements(b, i=0):
+    """ Iterate over (value, encoded element bytes) of a packed key starting at offset i
+    """
+    b = bytes(b)
+    while i < len(b):
+        v, end = _decode(b, i)
+        yield v, b[i:end]
+        i = end
+
+
+def strinc(b):
+    """ Smallest byte string that is greater than every string starting with b
+    """
+    b = bytes(b).rstrip(b'\xff')
+    if len(b) == 0:
+        raise ValueError('Key must contain a byte other than 0xFF')
+    return b[:-1] + bytes([b[-1] + 1])
+
+
+def box_scan(cursor, prefix, ranges):
+    """Skip scan over keys of the form ``prefix + pack_key((v1, v2, ..., vN, ...))``
+    yielding (key, value) for keys with every ``lo_i <= v_i <= hi_i``.
+
+    Instead of visiting every key under the prefix, cursor seeks past runs of
+    keys that are out of range in any dimension.
+
+    :cursor: LMDB cursor
+    :prefix bytes: Packed key prefix
+    :ranges: [(lo, hi)] packed bounds per dimension, inclusive
+    """
+    n = len(prefix)
+    ok = cursor.set_range(prefix + ranges[0][0])
+
+    while ok:
+        k = bytes(cursor.key())
+        if k[:n] != prefix:
+            return
+
+        parts = [e for _, e in iter_elements(k, n)]
+        target = None
+
+        for i, (lo, hi) in enumerate(ranges):
+            v = parts[i] if i < len(parts) else None
+            if v is None or v < lo:
+                target = prefix + b''.join(parts[:i]) + lo
+                break
+            if v > hi:
+                if i == 0:
+                    return
+                target = strinc(prefix + b''.join(parts[:i]))
+                break
+
+        if target is None:
+            yield k, cursor.value()
+            ok = cursor.next()
+        else:
+            ok = cursor.set_range(target)
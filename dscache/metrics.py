@@ -0,0 +1,190 @@
+""" Metrics collected from DatasetCache hot paths
+"""
+import threading
+from collections import OrderedDict
+
+COUNTERS = ('records_read',
+            'records_written',
+            'bytes_read',
+            'bytes_decompressed',
+            'bytes_compressed',
+            'bytes_written',
+            'read_transactions',
+            'write_transactions')
+
+TIMERS = ('decompress',
+          'json_parse',
+          'dataset_construct',
+          'compress',
+          'commit',
+          'stream_group')
+
+
+class CacheStats(object):
+    """Counters and timers, safe to update from several threads.
+
+    Callbacks are called on every update with ``(name, value, tags)``, where
+    value is an increment for counters and duration in seconds for timers,
+    tags is a dictionary (e.g. ``{'group': name}``) or None.
+
+    Per group timings are kept for the ``max_groups`` most recently streamed
+    groups only, callbacks see every group.
+    """
+
+    def __init__(self, callbacks=None, max_groups=1000):
+        self._lock = threading.Lock()
+        self._callbacks = list(callbacks or [])
+        self._max_groups = max_groups
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counters = {n: 0 for n in COUNTERS}
+            self._timers = {n: [0, 0.0] for n in TIMERS}
+            self._groups = OrderedDict()
+
+    def subscribe(self, callback):
+        self._callbacks.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        self._callbacks.remove(callback)
+
+    def inc(self, name, n=1, tags=None):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+        for cb in self._callbacks:
+            cb(name, n, tags)
+
+    def observe(self, name, seconds, tags=None):
+        with self._lock:
+            t = self._timers.setdefault(name, [0, 0.0])
+            t[0] += 1
+            t[1] += seconds
+        for cb in self._callbacks:
+            cb(name, seconds, tags)
+
+    def update(self, counters=None, timers=None, tags=None):
+        """ Add several counter increments and timer observations at once
+        """
+        counters = counters or {}
+        timers = timers or {}
+
+        with self._lock:
+            for name, n in counters.items():
+                self._counters[name] = self._counters.get(name, 0) + n
+            for name, seconds in timers.items():
+                t = self._timers.setdefault(name, [0, 0.0])
+                t[0] += 1
+                t[1] += seconds
+
+        for cb in self._callbacks:
+            for name, n in counters.items():
+                cb(name, n, tags)
+            for name, seconds in timers.items():
+                cb(name, seconds, tags)
+
+    def observe_group(self, group, count, seconds):
+        """ Record time spent in the cache while streaming all datasets of a group
+        """
+        with self._lock:
+            self._groups.pop(group, None)
+            self._groups[group] = dict(count=count, seconds=seconds)
+            while len(self._groups) > self._max_groups:
+                self._groups.popitem(last=False)
+        self.observe('stream_group', seconds, tags={'group': group})
+
+    def snapshot(self):
+        """ Copy of current values:
+
+        counters: {name: int}
+        timers: {name: {count: int, total: seconds}}
+        groups: {group_name: {count: datasets, seconds: float}}, most recent ``max_groups``
+        """
+        with self._lock:
+            return dict(counters=dict(self._counters),
+                        timers={n: dict(count=c, total=t) for n, (c, t) in self._timers.items()},
+                        groups={n: dict(g) for n, g in self._groups.items()})
+
+
+def diff_snapshots(before, after):
+    """ Subtract two snapshots, groups are taken from ``after``
+    """
+    def sub(a, b):
+        return {k: v - a.get(k, 0) for k, v in b.items()}
+
+    return dict(counters=sub(before['counters'], after['counters']),
+                timers={n: sub(before['timers'].get(n, {}), t) for n, t in after['timers'].items()},
+                groups=after['groups'])
+
+
+def prometheus_callback(prefix='dscache', registry=None):
+    """Construct callback that forwards updates to ``prometheus_client`` metrics.
+
+    Counters become Counters named ``{prefix}_{name}_total``, timers become
+    Histograms named ``{prefix}_{name}_seconds``. Tags are dropped to keep
+    label cardinality bounded.
+    """
+    from prometheus_client import Counter, Histogram, REGISTRY
+
+    registry = REGISTRY if registry is None else registry
+    counters = {n: Counter('{}_{}'.format(prefix, n), n.replace('_', ' '), registry=registry)
+                for n in COUNTERS}
+    timers = {n: Histogram('{}_{}_seconds'.format(prefix, n), n.replace('_', ' '), registry=registry)
+              for n in TIMERS}
+
+    def callback(name, value, tags):
+        if name in counters:
+            counters[name].inc(value)
+        elif name in timers:
+            timers[name].observe(value)
+
+    return callback
+
+
+def test_cache_stats():
+    seen = []
+    stats = CacheStats(callbacks=[lambda *args: seen.append(args)], max_groups=2)
+    before = stats.snapshot()
+
+    stats.inc('records_read', 3)
+    stats.update(counters=dict(records_read=1, bytes_read=10), timers=dict(decompress=0.5))
+    for g in ('a', 'b', 'c', 'b'):
+        stats.observe_group(g, 2, 0.25)
+
+    ss = stats.snapshot()
+    assert ss['counters']['records_read'] == 4 and ss['counters']['bytes_read'] == 10
+    assert ss['timers']['decompress'] == dict(count=1, total=0.5)
+    assert ss['timers']['stream_group'] == dict(count=4, total=1.0)
+    assert list(ss['groups']) == ['c', 'b']
+    assert [tags for name, _, tags in seen if name == 'stream_group'] == [{'group': g} for g in 'abcb']
+
+    d = diff_snapshots(before, ss)
+    assert d['counters']['records_read'] == 4 and d['counters']['write_transactions'] == 0
+
+    stats.reset()
+    assert stats.snapshot()['groups'] == {}
+
+
+def test_stream_group_stats(tmp_path):
+    import time
+    from .dscache import create_cache
+    from .tools.synthetic import gen_datasets
+
+    dss = list(gen_datasets(10))
+    cache = create_cache(str(tmp_path/'m.db'))
+    cache.bulk_save(dss)
+    cache.put_group('g', [ds.id for ds in dss])
+
+    stats = cache.enable_stats()
+    for _ in cache.stream_group('g'):
+        time.sleep(0.02)  # consumer time is not counted
+
+    ss = stats.snapshot()
+    assert ss['groups']['g']['count'] == 10
+    assert ss['groups']['g']['seconds'] < 0.1
+    assert ss['counters']['records_read'] == 10
+
+    cache.disable_stats()
+    assert sum(1 for _ in cache.stream_group('g')) == 10
+    assert stats.snapshot()['counters']['records_read'] == 10
@@ -0,0 +1,551 @@
+""" Sharded dataset cache: several LMDB files behind one DatasetCache-like facade
+"""
+import json
+import shutil
+import zlib
+from pathlib import Path
+from types import SimpleNamespace
+from uuid import UUID
+from concurrent.futures import ThreadPoolExecutor
+import toolz
+
+from .dscache import (key_to_bytes,
+                      uuids2bytes,
+                      create_cache,
+                      open_ro,
+                      open_rw)
+
+MANIFEST_VERSION = 1
+MANIFEST_NAME = 'manifest.json'
+PARTITION_MODES = ('uuid', 'product')
+
+
+def is_sharded(path):
+    """ Check if path points to a sharded cache (folder with a manifest file)
+    """
+    return (Path(path)/MANIFEST_NAME).exists()
+
+
+def load_manifest(path):
+    with open(str(Path(path)/MANIFEST_NAME), 'rt') as f:
+        manifest = json.load(f)
+
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise ValueError('Unsupported manifest version: {}'.format(manifest.get('version')))
+
+    return manifest
+
+
+def save_manifest(path, manifest):
+    fname = Path(path)/MANIFEST_NAME
+    tmp = Path(str(fname) + '.tmp')
+
+    with open(str(tmp), 'wt') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    tmp.replace(fname)
+
+
+class ShardedDatasetCache(object):
+    """
+    Folder layout:
+
+       manifest.json:
+          version: int
+          partition: uuid|product
+          shards: [relative path of each shard]
+          products: {product_name: shard_index} (product partition only),
+                    explicit assignments given at creation
+
+       shard-NNN/: regular dataset cache, all shards share compression dictionary
+
+    With ``uuid`` partition datasets are assigned to shards by the first byte
+    of the UUID, so every shard covers a contiguous range of the key space.
+    With ``product`` partition all datasets of a product live in one shard,
+    products not listed in the manifest are assigned by a stable hash of the
+    name, so assignment never depends on the order datasets were added in.
+
+    Groups are split by shard: each shard stores the members of the group that
+    live in that shard, so a subset of shards is a usable cache on its own.
+    """
+
+    def __init__(self, path, manifest, shards):
+        """ Don't use this directly, use create_sharded_cache or open_ro/open_rw.
+        """
+        self._path = Path(path)
+        self._manifest = manifest
+        self._shards = shards
+        self._nshards = len(shards)
+        self._by_product = manifest['partition'] == 'product'
+
+        live = self._live()
+        if len(live) == 0:
+            raise ValueError('No shards available in {}'.format(path))
+
+        self._zdict = live[0][1]._zdict
+        self._keyfmt = live[0][1]._keyfmt
+        self._intern = None  # shards are never created with interning
+
+    def _live(self):
+        return [(idx, shard) for idx, shard in enumerate(self._shards) if shard is not None]
+
+    def _shard(self, idx):
+        shard = self._shards[idx]
+        if shard is None:
+            raise ValueError('Shard {:d} is not available in this instance'.format(idx))
+        return shard
+
+    def sync(self):
+        for _, shard in self._live():
+            shard.sync()
+
+    def __del__(self):
+        self.sync()
+
+    def enable_stats(self, stats=None):
+        """Start collecting metrics from all shards into one CacheStats object
+        """
+        live = self._live()
+        stats = live[0][1].enable_stats(stats)
+        for _, shard in live[1:]:
+            shard.enable_stats(stats)
+        return stats
+
+    def disable_stats(self):
+        for _, shard in self._live():
+            shard.disable_stats()
+
+    @property
+    def stats(self):
+        return self._live()[0][1].stats
+
+    @property
+    def readonly(self):
+        return any(shard.readonly for _, shard in self._live())
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def manifest(self):
+        return self._manifest
+
+    @property
+    def shards(self):
+        """ List of shard caches, None in place of shards that were not opened
+        """
+        return list(self._shards)
+
+    @property
+    def products(self):
+        return toolz.merge(*[shard.products for _, shard in self._live()])
+
+    @property
+    def typed_keys(self):
+        return self._keyfmt is not None
+
+    def _uuid_shard(self, k):
+        return (k[0]*self._nshards) >> 8
+
+    def shard_index(self, ds):
+        """ Compute which shard dataset belongs to.
+
+        :ds: Dataset or raw dataset document
+        """
+        if isinstance(ds, dict):
+            product = ds['product']
+            uuid = UUID(toolz.get_in(['metadata', 'id'], ds))
+        else:
+            product = ds.type.name
+            uuid = ds.id
+
+        if not self._by_product:
+            return self._uuid_shard(key_to_bytes(uuid))
+
+        idx = self._manifest['products'].get(product)
+        if idx is None:
+            idx = _product_shard(product, self._nshards)
+        return idx
+
+    def owns(self, ds):
+        """ Check if dataset belongs to one of the shards opened by this instance
+        """
+        return self._shards[self.shard_index(ds)] is not None
+
+    def _locate(self, keys):
+        """ Find shard index for each key, None if not found in any available shard
+        """
+        if not self._by_product:
+            return [self._uuid_shard(k) for k in keys]
+
+        out = [None]*len(keys)
+        for idx, shard in self._live():
+            for i, d in enumerate(shard._get_raw_many(keys)):
+                if d is not None and out[i] is None:
+                    out[i] = idx
+        return out
+
+    def _split(self, items, get_idx):
+        parts = {}
+        for item in items:
+            parts.setdefault(get_idx(item), []).append(item)
+        return parts
+
+    def _parallel_save(self, items, save, get_idx):
+        """ Partition items by shard and write every shard from its own thread.
+        """
+        parts = self._split(items, get_idx)
+        if len(parts) == 0:
+            return
+
+        jobs = [(self._shard(idx), part) for idx, part in parts.items()]
+        with ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+            list(pool.map(lambda job: save(*job), jobs))
+
+    def bulk_save(self, dss, max_transaction_size=10000):
+        for chunk in toolz.partition_all(max_transaction_size, dss):
+            self._parallel_save(chunk,
+                                lambda shard, dss: shard.bulk_save(dss),
+                                self.shard_index)
+
+    def tee(self, dss, max_transaction_size=10000):
+        """Given a lazy stream of datasets persist them to disk and then pass through
+        for further processing.
+        :dss: stream of datasets
+        :max_transaction_size int: How often to commit results to disk
+        """
+        for chunk in toolz.partition_all(max_transaction_size, dss):
+            self._parallel_save(chunk,
+                                lambda shard, dss: shard.bulk_save(dss),
+                                self.shard_index)
+            yield from chunk
+
+        self.sync()
+
+    def bulk_save_raw(self, raw_dss, max_transaction_size=10000):
+        for chunk in toolz.partition_all(max_transaction_size, raw_dss):
+            self._parallel_save(chunk,
+                                lambda shard, docs: shard.bulk_save_raw(docs),
+                                self.shard_index)
+
+    def delete(self, uuid):
+        """ Remove dataset with a given uuid, returns True if it was present
+        """
+        return self.bulk_delete([uuid]) > 0
+
+    def bulk_delete(self, uuids, max_transaction_size=10000):
+        """ Remove datasets from the shards that hold them, see DatasetCache.bulk_delete
+        """
+        keys = [key_to_bytes(UUID(u) if isinstance(u, str) else u) for u in uuids]
+        if self._by_product:
+            parts = {idx: keys for idx, _ in self._live()}
+        else:
+            parts = self._split(keys, self._uuid_shard)
+
+        return sum(self._shard(idx).bulk_delete(part, max_transaction_size=max_transaction_size)
+                   for idx, part in parts.items())
+
+    def compact_groups(self):
+        """ Compact groups of every shard, returns summed statistics
+        """
+        rr = [shard.compact_groups() for _, shard in self._live()]
+        return SimpleNamespace(groups=sum(r.groups for r in rr),
+                               members=sum(r.members for r in rr),
+                               tombstones=sum(r.tombstones for r in rr))
+
+    def put_group(self, name, uuids, raw=False):
+        """ Group is a named list of uuids, members are stored with the shard that
+        holds the dataset.
+
+        :uuids: Sequence of UUIDs, or bytes-like object of concatenated 16 byte keys
+        :raw bool: Name is an encoded key as returned by ``groups(raw=True)``
+        """
+        if isinstance(uuids, (bytes, bytearray, memoryview)):
+            data = uuids2bytes(uuids)
+            keys = [data[i:i+16] for i in range(0, len(data), 16)]
+        else:
+            keys = [key_to_bytes(u) for u in uuids]
+
+        parts = {}
+        for k, idx in zip(keys, self._locate(keys)):
+            parts.setdefault(0 if idx is None else idx, []).append(k)
+
+        for idx, shard in enumerate(self._shards):
+            part = parts.get(idx)
+            if part is not None:
+                self._shard(idx).put_group(name, b''.join(part), raw)
+            elif shard is not None and shard._get_group_raw(name, raw) is not None:
+                shard.put_group(name, b'', raw)
+
+    def _get_group_raw(self, name, raw=False):
+        parts = [shard._get_group_raw(name, raw) for _, shard in self._live()]
+        parts = [p for p in parts if p is not None]
+        if len(parts) == 0:
+            return None
+        return b''.join(parts)
+
+    def _get_groups_raw(self, names):
+        out = [None]*len(names)
+        for _, shard in self._live():
+            for i, data in enumerate(shard._get_groups_raw(names)):
+                if data is not None:
+                    out[i] = data if out[i] is None else out[i] + data
+        return out
+
+    def get_group(self, name, raw=False):
+        """ Group is a named list of uuids, ordered by shard
+        """
+        data = self._get_group_raw(name, raw)
+        return None if data is None else [UUID(bytes=data[i:i+16]) for i in range(0, len(data), 16)]
+
+    def groups(self, raw=False, prefix=None):
+        """Get list of tuples (group_name, group_size), sizes are summed across shards.
+        """
+        return self._sum_groups(raw, lambda shard: shard.groups(raw=True, prefix=prefix))
+
+    def group_range(self, start=None, stop=None, raw=False):
+        """ See DatasetCache.group_range, sizes are summed across shards.
+        """
+        return self._sum_groups(raw, lambda shard: shard.group_range(start, stop, raw=True))
+
+    def groups_in_box(self, prefix, ranges, raw=False):
+        """ See DatasetCache.groups_in_box, sizes are summed across shards.
+        """
+        return self._sum_groups(raw, lambda shard: shard.groups_in_box(prefix, ranges, raw=True))
+
+    def _sum_groups(self, raw, query):
+        counts = {}
+        for _, shard in self._live():
+            for n, c in query(shard):
+                counts[n] = counts.get(n, 0) + c
+
+        nn = sorted(counts.items())
+        if raw:
+            return nn
+
+        shard = self._live()[0][1]
+        return [(shard._group_name(n), c) for n, c in nn]
+
+    def get(self, uuid):
+        """Extract single dataset with a given uuid, or return None if not found"""
+        if isinstance(uuid, str):
+            uuid = UUID(uuid)
+
+        if not self._by_product:
+            shard = self._shards[self._uuid_shard(key_to_bytes(uuid))]
+            return None if shard is None else shard.get(uuid)
+
+        for _, shard in self._live():
+            ds = shard.get(uuid)
+            if ds is not None:
+                return ds
+        return None
+
+    def get_all(self):
+        for _, shard in self._live():
+            yield from shard.get_all()
+
+    def stream_group(self, group_name, raw=False):
+        found = False
+        for _, shard in self._live():
+            if shard._get_group_raw(group_name, raw) is not None:
+                found = True
+                yield from shard.stream_group(group_name, raw)
+
+        if not found:
+            raise ValueError('No such group: %s' % (group_name,))
+
+    def _get_raw_many(self, keys):
+        out = [None]*len(keys)
+        for idx, shard in self._live():
+            sel = list(range(len(keys))) if self._by_product else [
+                i for i, k in enumerate(keys) if self._uuid_shard(k) == idx]
+            if len(sel) == 0:
+                continue
+
+            for i, d in zip(sel, shard._get_raw_many([keys[i] for i in sel])):
+                if d is not None and out[i] is None:
+                    out[i] = d
+        return out
+
+    def _tombstoned(self, keys):
+        out = set()
+        for idx, shard in self._live():
+            sel = keys if self._by_product else [k for k in keys if self._uuid_shard(k) == idx]
+            if len(sel) > 0:
+                out |= shard._tombstoned(sel)
+        return out
+
+    def _scan_raw(self, pos=None, limit=1000):
+        """ Same as DatasetCache._scan_raw, position is (shard_index, key)
+        """
+        live = self._live()
+        idx, key = (live[0][0], None) if pos is None else pos
+
+        for i, shard in live:
+            if i < idx:
+                continue
+
+            batch, key = shard._scan_raw(key if i == idx else None, limit=limit)
+            if key is not None:
+                return batch, (i, key)
+            if len(batch) > 0:
+                nxt = [j for j, _ in live if j > i]
+                return batch, ((nxt[0], None) if nxt else None)
+
+        return [], None
+
+    @property
+    def count(self):
+        return sum(shard.count for _, shard in self._live())
+
+
+def _shard_paths(path, manifest):
+    return [Path(path)/name for name in manifest['shards']]
+
+
+def _product_shard(product, nshards):
+    return zlib.crc32(product.encode('utf8')) % nshards
+
+
+def create_sharded_cache(path,
+                         nshards=16,
+                         partition='uuid',
+                         complevel=6,
+                         zdict=None,
+                         max_db_sz=None,
+                         truncate=False,
+                         typed_keys=False,
+                         products=None):
+    """Create new sharded cache in a folder.
+
+    :path str: Folder to create, will contain manifest and one folder per shard
+    :nshards int: Number of shards, at most 256 for uuid partition
+    :partition str: uuid|product
+    :max_db_sz int: Maximum size of each shard in bytes
+    :typed_keys bool: Use order preserving group name encoding, see create_cache
+    :products dict: {product_name: shard_index} for product partition, other
+                    products are assigned by a hash of the name
+    """
+    if partition not in PARTITION_MODES:
+        raise ValueError('Partition must be one of: ' + ','.join(PARTITION_MODES))
+
+    if not (0 < nshards <= 256):
+        raise ValueError('Number of shards must be in [1, 256]')
+
+    products = dict(products or {})
+    if products and partition != 'product':
+        raise ValueError('Product assignment requires product partition')
+    if any(not (0 <= idx < nshards) for idx in products.values()):
+        raise ValueError('Product shard index out of range')
+
+    path = Path(path)
+    if truncate and is_sharded(path):
+        for p in _shard_paths(path, load_manifest(path)):
+            if p.exists():
+                shutil.rmtree(str(p))
+        (path/MANIFEST_NAME).unlink()
+
+    if is_sharded(path):
+        return open_sharded(path, readonly=False, max_db_sz=max_db_sz, complevel=complevel)
+
+    path.mkdir(parents=True, exist_ok=True)
+    manifest = dict(version=MANIFEST_VERSION,
+                    partition=partition,
+                    shards=['shard-{:03d}'.format(i) for i in range(nshards)],
+                    products=products)
+
+    shards = [create_cache(str(p),
+                           complevel=complevel,
+                           zdict=zdict,
+                           max_db_sz=max_db_sz,
+                           typed_keys=typed_keys)
+              for p in _shard_paths(path, manifest)]
+
+    save_manifest(path, manifest)
+    return ShardedDatasetCache(path, manifest, shards)
+
+
+def open_sharded(path,
+                 readonly=True,
+                 shards=None,
+                 products=None,
+                 lock=False,
+                 max_db_sz=None,
+                 complevel=6):
+    """Open existing sharded cache.
+
+    :shards [int]: Only open these shards, default is all. Shards missing on
+    disk are skipped in readonly mode, this allows copying only relevant
+    shards to a worker node.
+    """
+    manifest = load_manifest(path)
+    paths = _shard_paths(path, manifest)
+    wanted = set(range(len(paths)) if shards is None else shards)
+
+    def _open(idx, p):
+        if idx not in wanted:
+            return None
+        if not p.exists():
+            if readonly:
+                return None
+            raise ValueError('Missing shard: {}'.format(p))
+
+        if readonly:
+            return open_ro(str(p), products=products, lock=lock)
+        return open_rw(str(p), products=products, max_db_sz=max_db_sz, complevel=complevel)
+
+    return ShardedDatasetCache(path, manifest, [_open(idx, p) for idx, p in enumerate(paths)])
+
+
+def test_product_partition(tmp_path):
+    from .tools.synthetic import gen_datasets
+
+    dss = list(gen_datasets(30))
+    names = sorted({ds.type.name for ds in dss})
+    cache = create_sharded_cache(tmp_path/'c', nshards=4, partition='product', products={names[0]: 3})
+    manifest = load_manifest(tmp_path/'c')
+
+    expect = {name: 3 if name == names[0] else _product_shard(name, 4) for name in names}
+    assert all(cache.shard_index(ds) == expect[ds.type.name] for ds in dss)
+    assert all(cache.owns(ds) for ds in dss)
+
+    cache.bulk_save(dss)
+    cache.sync()
+    assert load_manifest(tmp_path/'c') == manifest
+    assert [shard.count for shard in cache.shards] == [
+        sum(expect[ds.type.name] == idx for ds in dss) for idx in range(4)]
+
+    for ds in dss[:5]:
+        assert cache.delete(ds.id)
+    assert cache.count == 25
+
+
+def test_shard_subset(tmp_path):
+    from .tools.synthetic import gen_datasets
+
+    dss = list(gen_datasets(40))
+    ids = [ds.id for ds in dss]
+    cache = create_sharded_cache(tmp_path/'c', nshards=4)
+    cache.bulk_save(dss)
+    cache.put_group('g', ids)
+
+    owner = {ds.id: cache.shard_index(ds) for ds in dss}
+    for idx, shard in enumerate(cache.shards):
+        assert shard.get_group('g') == sorted([u for u in ids if owner[u] == idx], key=ids.index)
+    assert sorted(cache.get_group('g')) == sorted(ids)
+
+    dead = ids[:10] + ids[:2]
+    assert cache.bulk_delete(dead) == 10
+    assert [shard.count for shard in cache.shards] == [
+        sum(owner[u] == idx for u in ids[10:]) for idx in range(4)]
+    assert sorted(ds.id for ds in cache.stream_group('g')) == sorted(ids[10:])
+    cache.sync()
+    del cache, shard
+
+    sub = open_sharded(tmp_path/'c', shards=[0, 2])
+    assert [shard is not None for shard in sub.shards] == [True, False, True, False]
+    live = [u for u in ids[10:] if owner[u] in (0, 2)]
+    assert sub.count == len(live)
+    assert sorted(ds.id for ds in sub.stream_group('g')) == sorted(live)
+    assert [sub.owns(ds) for ds in dss] == [owner[ds.id] in (0, 2) for ds in dss]
@@ -1,6 +1,9 @@
 """
 """
+import os
 import random
+from uuid import UUID
+import toolz
 from .. import train_dictionary
 
 
@@ -97,23 +100,135 @@ class DcTileExtract(object):
                  key_fmt=None,
                  grid_spec=None):
         from datacube.api.query import query_group_by
-        from .dstiler import GS_ALBERS
+        from ..apps.dstiler import GS_ALBERS
 
         self._cache = cache
         self._grouper = query_group_by(group_by=group_by)
         self._grid_spec = GS_ALBERS if grid_spec is None else grid_spec
-        self._key_fmt = 'albers/{:+03d}{:+03d}' if key_fmt is None else key_fmt
-
-    def __call__(self, tile_idx, _y=None):
+        if key_fmt is None:
+            key_fmt = ('albers',) if cache.typed_keys else 'albers/{:+03d}{:+03d}'
+        self._key_fmt = key_fmt
+        self._geoboxes = {}
+
+    def _geobox(self, tile_idx):
+        geobox = self._geoboxes.get(tile_idx)
+        if geobox is None:
+            geobox = self._geoboxes[tile_idx] = self._grid_spec.tile_geobox(tile_idx)
+        return geobox
+
+    def _group_name(self, tile_idx):
+        if isinstance(self._key_fmt, tuple):
+            return self._key_fmt + tuple(tile_idx)
+        return self._key_fmt.format(*tile_idx)
+
+    def _mk_tile(self, dss, geobox):
         from datacube import Datacube
         from datacube.api.grid_workflow import Tile
 
+        sources = Datacube.group_datasets(dss, self._grouper)
+        return Tile(sources, geobox)
+
+    def __call__(self, tile_idx, _y=None):
         if _y is not None:
             tile_idx = (tile_idx, _y)
 
-        k = self._key_fmt.format(*tile_idx)
-        dss = list(self._cache.stream_group(k))
-
-        geobox = self._grid_spec.tile_geobox(tile_idx)
-        sources = Datacube.group_datasets(dss, self._grouper)
-        return Tile(sources, geobox)
+        dss = list(self._cache.stream_group(self._group_name(tile_idx)))
+
+        return self._mk_tile(dss, self._geobox(tuple(tile_idx)))
+
+    def batch(self, tile_indices, workers=None, chunk_size=64):
+        """Construct Tile objects for many tiles, yields ``(tile_idx, Tile)`` in completion order.
+
+        Group membership of all tiles is read up front in one read transaction
+        (one per shard for sharded caches). Tiles are processed in chunks of
+        ``chunk_size``: datasets needed by a chunk are fetched in one short
+        read transaction and decoded once in parallel and shared between
+        neighbouring tiles, then tiles are constructed in parallel. Decoded datasets are
+        released as soon as no remaining tile refers to them, so supply tiles
+        in spatial order for best reuse. Repeated tile indexes are processed once.
+
+        Works with plain and sharded caches.
+
+        :tile_indices: Sequence of (x, y) tile indexes
+        :workers int: Number of worker threads
+        :chunk_size int: Number of tiles to process at once
+        """
+        from collections import Counter
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+        from ..dscache import _decode_dss
+
+        cache = self._cache
+        tile_indices = list(dict.fromkeys(tuple(idx) for idx in tile_indices))
+        workers = workers or os.cpu_count()
+
+        names = [self._group_name(idx) for idx in tile_indices]
+        members = {}
+        for idx, k, data in zip(tile_indices, names, cache._get_groups_raw(names)):
+            if data is None:
+                raise ValueError('No such group: %s' % (k,))
+            if len(data) & 0xF:
+                raise ValueError('Wrong data size for group %s' % (k,))
+            members[idx] = [data[i:i+16] for i in range(0, len(data), 16)]
+
+        refs = Counter(k for kk in members.values() for k in kk)
+        decoded = {}
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            def decode(keys):
+                raw = cache._get_raw_many(keys)
+                for k, d in zip(keys, raw):
+                    if d is None:
+                        raise ValueError('Missing dataset for %s' % (str(UUID(bytes=k))))
+
+                step = max(1, len(keys)//(4*workers))
+                chunks = [(keys[i:i+step], raw[i:i+step]) for i in range(0, len(keys), step)]
+                futures = [(kk, pool.submit(_decode_dss, cache._zdict, cache.products, rr, cache._intern))
+                           for kk, rr in chunks]
+                for kk, f in futures:
+                    decoded.update(zip(kk, f.result()))
+
+            for chunk in toolz.partition_all(chunk_size, tile_indices):
+                decode(list({k for idx in chunk for k in members[idx] if k not in decoded}))
+
+                futures = {pool.submit(self._mk_tile,
+                                       [decoded[k] for k in members[idx]],
+                                       self._geobox(idx)): idx
+                           for idx in chunk}
+
+                for idx in chunk:
+                    for k in members.pop(idx):
+                        refs[k] -= 1
+                        if refs[k] == 0:
+                            del decoded[k]
+
+                for f in as_completed(futures):
+                    yield futures[f], f.result()
+
+
+def test_tile_extract_batch(tmp_path):
+    from .. import create_cache, create_sharded_cache
+    from ..apps.dstiler import GS_ALBERS
+    from .synthetic import gen_datasets
+    from .tiling import bin_dataset_stream
+
+    def ids(tile):
+        return sorted(ds.id for dss in tile.sources.values for ds in dss)
+
+    dss = list(gen_datasets(300))
+    bins = bin_dataset_stream(GS_ALBERS, dss)
+    idxs = sorted(bins)[:20]
+
+    for cache in (create_cache(str(tmp_path/'plain.db')),
+                  create_sharded_cache(tmp_path/'sharded', nshards=4)):
+        cache.bulk_save(dss)
+        for b in bins.values():
+            cache.put_group('albers/{:+03d}{:+03d}'.format(*b.idx), b.dss)
+
+        extract = DcTileExtract(cache)
+        tiles = list(extract.batch(idxs + idxs[:5], chunk_size=7, workers=2))
+        assert sorted(idx for idx, _ in tiles) == idxs
+
+        for idx, tile in tiles:
+            expect = extract(idx)
+            assert tile.geobox == expect.geobox
+            assert ids(tile) == ids(expect) == sorted(bins[idx].dss)
@@ -0,0 +1,389 @@
+""" Reproducible benchmarks of cache hot paths on synthetic data
+
+Results are plain dictionaries that can be saved as JSON and compared across
+commits with ``compare_results``.
+"""
+import json
+import random
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import datetime
+from pathlib import Path
+from types import SimpleNamespace
+import timeit
+import zstandard
+
+from .. import create_cache, train_dictionary
+from ..dscache import ds2bytes
+from ..intern import Interner
+from . import mk_raw2ds
+from .synthetic import mk_products, gen_raw_datasets
+from .tiling import bin_dataset_stream, bin_by_native_tile
+
+RESULTS_VERSION = 1
+
+timer = timeit.default_timer
+
+
+def _reset_peak_rss():
+    """Reset peak resident memory of this process to current value, so that
+    peak can be measured per benchmark. Returns False if not supported (Linux only).
+    """
+    try:
+        with open('/proc/self/clear_refs', 'wt') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _rss():
+    """ (current, peak) resident memory of this process in bytes, current is None if unknown
+    """
+    try:
+        with open('/proc/self/status', 'rt') as f:
+            vv = dict(line.split(':', 1) for line in f if line.startswith(('VmRSS', 'VmHWM')))
+        return int(vv['VmRSS'].split()[0])*1024, int(vv['VmHWM'].split()[0])*1024
+    except (OSError, KeyError, ValueError):
+        # Peak since process start, Linux reports Kb
+        return None, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+
+def _measure(bench, ctx):
+    """Run one benchmark recording peak resident memory while it runs,
+    ``rss_growth`` is peak minus memory in use at start (None if peak can not be reset).
+    """
+    reset = _reset_peak_rss()
+    rss0, _ = _rss()
+
+    rr = bench(ctx)
+
+    _, peak = _rss()
+    rr.update(peak_rss=peak,
+              rss_growth=peak - rss0 if reset and rss0 is not None else None)
+    return rr
+
+
+def _db_bytes(cache):
+    """ Bytes used by LMDB pages, excluding unused part of the file
+    """
+    env = cache._dbs.main
+    return (env.info()['last_pgno'] + 1)*env.stat()['psize']
+
+
+def _percentiles(lat, qq=(50, 90, 99)):
+    if len(lat) == 0:
+        return {}
+    lat = sorted(lat)
+    n = len(lat)
+    out = {'p{:d}'.format(q): lat[min(n - 1, (n*q)//100)]*1000 for q in qq}
+    out['max'] = lat[-1]*1000
+    return out
+
+
+def _report(count, total, lat=None, **extra):
+    rr = dict(count=count,
+              total_sec=total,
+              per_sec=count/total if total > 0 else None)
+    if lat is not None:
+        rr['latency_ms'] = _percentiles(lat)
+    rr.update(extra)
+    return rr
+
+
+def _time_stream(items):
+    """ Consume iterator recording time taken to produce every item
+    """
+    lat = []
+    t00 = t_prev = timer()
+    for _ in items:
+        t = timer()
+        lat.append(t - t_prev)
+        t_prev = t
+    return _report(len(lat), timer() - t00, lat)
+
+
+def _time_calls(fn, args):
+    lat = []
+    t00 = timer()
+    for a in args:
+        t0 = timer()
+        fn(a)
+        lat.append(timer() - t0)
+    return _report(len(lat), timer() - t00, lat)
+
+
+def _new_cache(ctx, name, zdict=None, intern=False):
+    return create_cache(str(ctx.workdir/name), zdict=zdict, truncate=True, intern=intern)
+
+
+def bench_ingest_bulk_save(ctx):
+    cache = _new_cache(ctx, 'bulk_save.db', ctx.zdict)
+    t0 = timer()
+    cache.bulk_save(ctx.dss)
+    cache.sync()
+    return _report(len(ctx.dss), timer() - t0, bytes_on_disk=_db_bytes(cache))
+
+
+def bench_ingest_bulk_save_intern(ctx):
+    cache = ctx.cache_intern = _new_cache(ctx, 'bulk_save_intern.db', ctx.zdict, intern=True)
+    t0 = timer()
+    cache.bulk_save(ctx.dss)
+    cache.sync()
+    return _report(len(ctx.dss), timer() - t0, bytes_on_disk=_db_bytes(cache))
+
+
+def bench_ingest_tee(ctx):
+    cache = _new_cache(ctx, 'tee.db', ctx.zdict)
+    rr = _time_stream(cache.tee(iter(ctx.dss), max_transaction_size=1000))
+    rr['bytes_on_disk'] = _db_bytes(cache)
+    return rr
+
+
+def bench_ingest_bulk_save_raw(ctx):
+    cache = _new_cache(ctx, 'bulk_save_raw.db', ctx.zdict)
+    t0 = timer()
+    cache.bulk_save_raw(ctx.raw)
+    return _report(len(ctx.raw), timer() - t0, bytes_on_disk=_db_bytes(cache))
+
+
+def bench_get(ctx):
+    rng = random.Random(ctx.seed)
+    uu = [ds.id for ds in rng.sample(ctx.dss, min(len(ctx.dss), 5000))]
+    return _time_calls(ctx.cache.get, uu)
+
+
+def bench_get_all(ctx):
+    return _time_stream(ctx.cache.get_all())
+
+
+def _bins_nbytes(bins):
+    """ Approximate memory used by bin member lists, counting every list entry
+    as a separate UUID object (as is the case when datasets are streamed)
+    """
+    n = 0
+    for cell in bins.values():
+        n += sys.getsizeof(cell.dss)
+        if isinstance(cell.dss, list):
+            n += sum(sys.getsizeof(u) + sys.getsizeof(u.int) for u in cell.dss)
+    return n
+
+
+def bench_get_all_intern(ctx):
+    if ctx.cache_intern is None:
+        bench_ingest_bulk_save_intern(ctx)
+    return _time_stream(ctx.cache_intern.get_all())
+
+
+def bench_bin_albers(ctx):
+    from ..apps.dstiler import GS_ALBERS
+
+    t0 = timer()
+    bins = bin_dataset_stream(GS_ALBERS, iter(ctx.dss))
+    ctx.bins = bins
+    return _report(len(ctx.dss), timer() - t0, bins=len(bins), members_bytes=_bins_nbytes(bins))
+
+
+def bench_bin_albers_compact(ctx):
+    from ..apps.dstiler import GS_ALBERS
+
+    t0 = timer()
+    bins = bin_dataset_stream(GS_ALBERS, iter(ctx.dss), compact=True)
+    return _report(len(ctx.dss), timer() - t0, bins=len(bins), members_bytes=_bins_nbytes(bins))
+
+
+def bench_bin_native(ctx):
+    t0 = timer()
+    bins = bin_by_native_tile(iter(ctx.dss))
+    return _report(len(ctx.dss), timer() - t0, bins=len(bins))
+
+
+def bench_put_group(ctx):
+    if ctx.bins is None:
+        bench_bin_albers(ctx)
+
+    groups = [('albers/{:+03d}{:+03d}'.format(*b.idx), b.dss) for b in ctx.bins.values()]
+    ctx.group_names = [n for n, _ in groups]
+    rr = _time_calls(lambda g: ctx.cache_rw.put_group(*g), groups)
+    rr['members'] = sum(len(dss) for _, dss in groups)
+    return rr
+
+
+def bench_get_group(ctx):
+    if ctx.group_names is None:
+        bench_put_group(ctx)
+    return _time_calls(ctx.cache.get_group, ctx.group_names)
+
+
+def bench_stream_group(ctx):
+    if ctx.group_names is None:
+        bench_put_group(ctx)
+
+    t0 = timer()
+    rr = _time_calls(lambda g: sum(1 for _ in ctx.cache.stream_group(g)), ctx.group_names)
+    n = sum(c for _, c in ctx.cache.groups(prefix='albers/'))
+    rr.update(datasets=n, datasets_per_sec=n/(timer() - t0))
+    return rr
+
+
+def _bench_compression(ctx, zdict, intern=None):
+    comp_params = {'dict_data': zstandard.ZstdCompressionDict(zdict)} if zdict else {}
+    comp = zstandard.ZstdCompressor(level=6, **comp_params)
+    decomp = zstandard.ZstdDecompressor(**comp_params)
+    docs = [ds2bytes(ds, intern)[1] for ds in ctx.dss]
+
+    t0 = timer()
+    cc = [comp.compress(d) for d in docs]
+    t_comp = timer() - t0
+
+    t0 = timer()
+    for c in cc:
+        decomp.decompress(c)
+    t_decomp = timer() - t0
+
+    n_raw, n_comp = sum(map(len, docs)), sum(map(len, cc))
+    return _report(len(docs), t_comp,
+                   decompress_per_sec=len(docs)/t_decomp,
+                   bytes_raw=n_raw,
+                   bytes_compressed=n_comp,
+                   ratio=n_raw/n_comp)
+
+
+def bench_compress_dict(ctx):
+    return _bench_compression(ctx, ctx.zdict)
+
+
+def bench_compress_nodict(ctx):
+    return _bench_compression(ctx, None)
+
+
+def bench_compress_dict_intern(ctx):
+    return _bench_compression(ctx, ctx.zdict, Interner())
+
+
+BENCHMARKS = [
+    ('ingest_bulk_save', bench_ingest_bulk_save),
+    ('ingest_tee', bench_ingest_tee),
+    ('ingest_bulk_save_raw', bench_ingest_bulk_save_raw),
+    ('ingest_bulk_save_intern', bench_ingest_bulk_save_intern),
+    ('get', bench_get),
+    ('get_all', bench_get_all),
+    ('get_all_intern', bench_get_all_intern),
+    ('bin_albers', bench_bin_albers),
+    ('bin_albers_compact', bench_bin_albers_compact),
+    ('bin_native', bench_bin_native),
+    ('put_group', bench_put_group),
+    ('get_group', bench_get_group),
+    ('stream_group', bench_stream_group),
+    ('compress_dict', bench_compress_dict),
+    ('compress_nodict', bench_compress_nodict),
+    ('compress_dict_intern', bench_compress_dict_intern),
+]
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=str(Path(__file__).parent),
+                                       stderr=subprocess.DEVNULL).decode('utf8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(n=10000, seed=0, only=None, workdir=None, log=None):
+    """Run benchmark suite on ``n`` synthetic datasets.
+
+    :only: List of benchmark names to run, default is all
+    :workdir str: Folder for temporary caches, default is a new temp folder
+    :log: Callable taking benchmark name, called before each benchmark
+
+    Returns dictionary suitable for saving as JSON
+    """
+    names = [name for name, _ in BENCHMARKS]
+    for name in (only or []):
+        if name not in names:
+            raise ValueError('No such benchmark: ' + name)
+
+    tmp = None
+    if workdir is None:
+        workdir = tmp = tempfile.mkdtemp(prefix='dscache-bench-')
+    workdir = Path(workdir)
+    workdir.mkdir(parents=True, exist_ok=True)
+
+    products = mk_products()
+    raw = list(gen_raw_datasets(n, products, seed=seed))
+    dss = list(map(mk_raw2ds(products), raw))
+
+    ctx = SimpleNamespace(seed=seed,
+                          workdir=workdir,
+                          products=products,
+                          raw=raw,
+                          dss=dss,
+                          zdict=train_dictionary(dss[:1000], 8*1024),
+                          bins=None,
+                          cache_intern=None,
+                          group_names=None)
+
+    path = str(workdir/'main.db')
+    ctx.cache_rw = create_cache(path, zdict=ctx.zdict, truncate=True)
+    ctx.cache_rw.bulk_save(dss)
+    ctx.cache_rw.sync()
+    ctx.cache = ctx.cache_rw
+
+    results = {}
+    try:
+        for name, bench in BENCHMARKS:
+            if only and name not in only:
+                continue
+            if log is not None:
+                log(name)
+            results[name] = _measure(bench, ctx)
+    finally:
+        del ctx
+        if tmp is not None:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    meta = dict(timestamp=datetime.datetime.utcnow().isoformat(),
+                git=_git_commit(),
+                python=platform.python_version(),
+                platform=platform.platform(),
+                n=n,
+                seed=seed)
+
+    return dict(version=RESULTS_VERSION, meta=meta, results=results)
+
+
+def save_results(results, fname):
+    with open(fname, 'wt') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def load_results(fname):
+    with open(fname, 'rt') as f:
+        results = json.load(f)
+    if results.get('version') != RESULTS_VERSION:
+        raise ValueError('Unsupported results version: {}'.format(results.get('version')))
+    return results
+
+
+def compare_results(old, new):
+    """Compare two result sets, returns list of
+    (name, old per_sec, new per_sec, speedup, old p50 ms, new p50 ms)
+    for benchmarks present in both.
+    """
+    out = []
+    for name, rn in new['results'].items():
+        ro = old['results'].get(name)
+        if ro is None:
+            continue
+
+        a, b = ro.get('per_sec'), rn.get('per_sec')
+        speedup = b/a if a and b else None
+        p50 = [r.get('latency_ms', {}).get('p50') for r in (ro, rn)]
+        out.append((name, a, b, speedup) + tuple(p50))
+
+    return out
@@ -0,0 +1,226 @@
+""" Integrity checks for dataset caches
+"""
+import json
+import os
+from uuid import UUID
+from types import SimpleNamespace
+from concurrent.futures import ProcessPoolExecutor
+
+from .. import open_rw
+from ..dscache import _decompressor
+from .partition import key_partitions, open_shared, release_shared, _cache_files
+
+
+def _key2s(k):
+    return str(UUID(bytes=k)) if len(k) == 16 else k.hex()
+
+
+def _check_record(k, d, decomp, products, intern=None):
+    """ Returns None if record is fine, or error description
+    """
+    if len(k) != 16:
+        return 'key is not 16 bytes'
+
+    try:
+        doc = json.loads(decomp.decompress(d))
+    except Exception as e:  # zstd and json errors
+        return 'failed to decode: {}'.format(e)
+
+    if not isinstance(doc, dict) or 'metadata' not in doc or 'product' not in doc:
+        return 'not a dataset document'
+
+    if intern is not None:
+        try:
+            intern.expand(doc)
+        except (IndexError, TypeError, ValueError) as e:
+            return 'bad interned reference: {}'.format(e)
+
+    if doc['product'] not in products:
+        return 'no such product: {}'.format(doc['product'])
+
+    ds_id = doc['metadata'].get('id') if isinstance(doc['metadata'], dict) else None
+    if ds_id != str(UUID(bytes=k)):
+        return 'id mismatch: {}'.format(ds_id)
+
+    return None
+
+
+def check_records(part):
+    """ Check every record in a key partition, runs in a worker process.
+
+    Returns (number of records checked, [(key, reason)])
+    """
+    cache = open_shared(part.path)
+    decomp = _decompressor(cache._zdict)
+    dbs = cache._dbs
+    stop = part.stop
+
+    n, bad = 0, []
+    with dbs.main.begin(dbs.ds, buffers=True) as tr:
+        cursor = tr.cursor()
+        ok = cursor.first() if part.start is None else cursor.set_range(part.start)
+
+        while ok:
+            k = bytes(cursor.key())
+            if stop is not None and k >= stop:
+                break
+
+            n += 1
+            err = _check_record(k, cursor.value(), decomp, cache.products, cache._intern)
+            if err is not None:
+                bad.append((k, err))
+            ok = cursor.next()
+
+    return n, bad
+
+
+def check_groups(path, names):
+    """ Check that group data is a whole number of UUIDs and that every member
+    resolves to a dataset, members deleted since last group compaction are fine.
+
+    Returns [(group_name, reason, [missing keys])]
+    """
+    cache = open_shared(path)
+    dbs = cache._dbs
+    out = []
+
+    with dbs.main.begin(dbs.groups) as tr_g, dbs.main.begin(dbs.ds, buffers=True) as tr:
+        for name in names:
+            data = tr_g.get(name)
+            if len(data) & 0xF:
+                out.append((name, 'size {:d} is not a multiple of 16'.format(len(data)), []))
+
+            data = cache._drop_deleted(tr, data)
+            missing = [data[i:i+16] for i in range(0, len(data) & ~0xF, 16)
+                       if tr.get(data[i:i+16]) is None]
+            if missing:
+                out.append((name, '{:d} missing datasets'.format(len(missing)), missing))
+
+    return out
+
+
+def _run(pool, fn, args):
+    if pool is None:
+        return [fn(*a) for a in args]
+    return [f.result() for f in [pool.submit(fn, *a) for a in args]]
+
+
+def _repair(path, bad_records):
+    """ Delete broken records and compact groups, then drop remaining dangling
+    members from all groups and truncate groups that are not a whole number of UUIDs.
+
+    Returns number of records deleted plus number of groups changed
+    """
+    cache = open_rw(path)
+    dbs = cache._dbs
+    n = cache.bulk_delete([k for k, _ in bad_records])
+    n += cache.compact_groups().groups
+
+    with cache._write_txn(dbs.groups) as tr:
+        for name, data in list(tr.cursor(db=dbs.groups)):
+            keep = [data[i:i+16] for i in range(0, len(data) & ~0xF, 16)
+                    if tr.get(data[i:i+16], db=dbs.ds) is not None]
+            keep = b''.join(keep)
+            if keep != data:
+                tr.put(name, keep, db=dbs.groups)
+                n += 1
+
+    return n
+
+
+def check_cache(path, workers=None, repair=False, log=None):
+    """Verify that every record decompresses, parses, matches its key and refers to
+    a known product, and that all groups are well formed and fully resolvable.
+
+    :path str: Cache file, or folder of a sharded cache
+    :workers int: Number of worker processes, 0 to check in this process
+    :repair bool: Delete broken records and remove dangling group members,
+    ``repaired`` in the result is the number of deleted records plus changed groups
+    :log: Callable taking a progress message
+
+    Returns SimpleNamespace(datasets, groups, bad_records, bad_groups, repaired)
+    where bad_records is [(path, uuid, reason)] and bad_groups is
+    [(path, group_name, reason, [missing uuids])]
+    """
+    log = log or (lambda msg: None)
+    workers = os.cpu_count() if workers is None else workers
+
+    files = _cache_files(path)
+    parts = key_partitions(path, max(1, 4*workers))
+
+    group_jobs = []
+    for p in files:
+        names = [n for n, _ in open_shared(p).groups(raw=True)]
+        step = max(1, len(names)//max(1, 4*workers))
+        group_jobs.extend((p, names[i:i+step]) for i in range(0, len(names), step))
+        # workers open their own, environments must not be shared across fork
+        release_shared(p)
+
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 0 else None
+    try:
+        log('Checking {:,d} record partitions'.format(len(parts)))
+        rr = _run(pool, check_records, [(part,) for part in parts])
+
+        log('Checking groups')
+        gg = _run(pool, check_groups, group_jobs)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        for p in files:
+            release_shared(p)
+
+    bad_records = [(part.path, k, err) for part, (_, bad) in zip(parts, rr) for k, err in bad]
+    bad_groups = [(p, name, err, missing)
+                  for (p, _), bad in zip(group_jobs, gg) for name, err, missing in bad]
+
+    repaired = 0
+    if repair and (bad_records or bad_groups):
+        for p in files:
+            log('Repairing {}'.format(p))
+            repaired += _repair(p, [(k, err) for pp, k, err in bad_records if pp == p])
+
+    return SimpleNamespace(datasets=sum(n for n, _ in rr),
+                           groups=sum(len(names) for _, names in group_jobs),
+                           bad_records=[(p, _key2s(k), err) for p, k, err in bad_records],
+                           bad_groups=[(p, name, err, [_key2s(k) for k in missing])
+                                       for p, name, err, missing in bad_groups],
+                           repaired=repaired)
+
+
+def test_check_repair(tmp_path):
+    from uuid import uuid4
+    from .. import create_cache
+    from .synthetic import gen_datasets
+
+    path = str(tmp_path/'c.db')
+    dss = list(gen_datasets(100))
+    ids = [ds.id for ds in dss]
+    cache = create_cache(path)
+    cache.bulk_save(dss)
+    cache.put_group('a', ids[:10])
+    cache.put_group('bad', ids[10:13] + [uuid4()])
+    dbs = cache._dbs
+    with dbs.main.begin(write=True) as tr:
+        tr.put(b'short', b'x'*20, db=dbs.groups)
+        tr.put(ids[5].bytes, b'garbage', db=dbs.ds)
+    del cache, dbs, tr
+
+    for workers in (0, 2):
+        rr = check_cache(path, workers=workers)
+        assert rr.datasets == 100 and rr.groups == 3 and rr.repaired == 0
+        assert [(k, err.startswith('failed to decode')) for _, k, err in rr.bad_records] == [(str(ids[5]), True)]
+        assert sorted((name, err) for _, name, err, _ in rr.bad_groups) == [
+            (b'bad', '1 missing datasets'),
+            (b'short', '1 missing datasets'),
+            (b'short', 'size 20 is not a multiple of 16')]
+
+    rr = check_cache(path, workers=0, repair=True)
+    assert rr.repaired == 4  # one record, groups a, bad and short
+
+    rr = check_cache(path, workers=0)
+    assert (rr.datasets, rr.bad_records, rr.bad_groups) == (99, [], [])
+
+    cache = open_rw(path)
+    assert cache.get_group('a') == ids[:5] + ids[6:10]
+    assert cache.get_group('bad') == ids[10:13]
+    assert cache.get_group('short') == []
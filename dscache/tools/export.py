@@ -0,0 +1,297 @@
+""" Export cache contents as Arrow record batches or Parquet files
+"""
+import os
+import json
+import datetime
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import toolz
+
+from .. import open_ro
+from ..dscache import _WORKER, _worker_args, _init_decode_worker, _decode_worker
+
+DEFAULT_FIELDS = ('id', 'product', 'time', 'uris', 'extent')
+
+
+def _utc(t):
+    if t is None:
+        return None
+    if t.tzinfo is None:
+        return t.replace(tzinfo=datetime.timezone.utc)
+    return t.astimezone(datetime.timezone.utc)
+
+
+def _extent_wkt(ds):
+    from datacube.utils.geometry import CRS
+
+    if ds.extent is None:
+        return None
+    return ds.extent.to_crs(CRS('EPSG:4326')).wkt
+
+
+def _plain(v):
+    """ Convert namedtuples (like Range) to dictionaries, so they become arrow structs
+    """
+    if hasattr(v, '_asdict'):
+        return {k: _plain(x) for k, x in v._asdict().items()}
+    if isinstance(v, datetime.datetime):
+        return _utc(v)
+    return v
+
+
+_EXTRACTORS = {
+    'id': lambda ds: str(ds.id),
+    'product': lambda ds: ds.type.name,
+    'time': lambda ds: _utc(ds.center_time),
+    'uris': lambda ds: list(ds.uris),
+    'extent': _extent_wkt,
+    'crs': lambda ds: None if ds.crs is None else str(ds.crs),
+}
+
+
+def _field_extractor(field):
+    """ Field is either one of the builtin names, ``doc:dotted.path`` into
+    metadata document, or a search field name of the metadata type.
+
+    Returns (column_name, Dataset -> value)
+    """
+    ex = _EXTRACTORS.get(field)
+    if ex is not None:
+        return field, ex
+
+    if field.startswith('doc:'):
+        path = field[4:].split('.')
+        return field[4:], lambda ds: toolz.get_in(path, ds.metadata_doc)
+
+    return field, lambda ds: _plain(getattr(ds.metadata, field, None))
+
+
+def _arrow_type(type_name):
+    """ Arrow type for a search field type name, None if not known
+    """
+    import pyarrow as pa
+
+    base, _, kind = type_name.partition('-')
+    t = {'string': pa.string(),
+         'double': pa.float64(),
+         'numeric': pa.float64(),
+         'float': pa.float64(),
+         'integer': pa.int64(),
+         'boolean': pa.bool_(),
+         'datetime': pa.timestamp('us', tz='UTC')}.get(base)
+
+    if t is None or kind not in ('', 'range'):
+        return None
+    if kind == 'range':
+        return pa.struct([('begin', t), ('end', t)])
+    return t
+
+
+def _column_types(fields, products):
+    """Arrow type for every column, derived from search field types of the
+    metadata types, ``doc:`` paths use the type of a search field with that
+    offset. Columns of unknown type are None.
+
+    Returns [(column_name, type|None)]
+    """
+    import pyarrow as pa
+
+    builtin = {'id': pa.string(),
+               'product': pa.string(),
+               'time': pa.timestamp('us', tz='UTC'),
+               'uris': pa.list_(pa.string()),
+               'extent': pa.string(),
+               'crs': pa.string()}
+
+    search = {}
+    by_offset = {}
+    for p in products.values():
+        for name, f in p.metadata_type.dataset_fields.items():
+            search.setdefault(name, f.type_name)
+            offset = getattr(f, '_offset', None)
+            if offset is not None:
+                by_offset.setdefault(tuple(offset), f.type_name)
+
+    out = []
+    for field in fields:
+        name, _ = _field_extractor(field)
+        if field in builtin:
+            t = builtin[field]
+        elif field.startswith('doc:'):
+            type_name = by_offset.get(tuple(name.split('.')))
+            t = None if type_name is None else _arrow_type(type_name)
+        else:
+            t = _arrow_type(search.get(field, ''))
+        out.append((name, t))
+    return out
+
+
+def _to_str(v):
+    if v is None or isinstance(v, str):
+        return v
+    return json.dumps(v, default=str)
+
+
+def _init_worker(fields, intern, *args):
+    """ See ``_init_decode_worker``, also sets up column extractors
+    """
+    _init_decode_worker(*args)
+    _WORKER.update(intern=intern, fields=[_field_extractor(f) for f in fields])
+
+
+def _batch2columns(batch, intern=None):
+    """ Decode raw records into a dictionary of columns, runs in a worker process
+
+    :intern: Current intern tables, overrides the copy worker was started with
+    """
+    fields = _WORKER['fields']
+    cols = {name: [] for name, _ in fields}
+    for ds in _decode_worker(batch, intern or _WORKER['intern']):
+        for name, ex in fields:
+            cols[name].append(ex(ds))
+
+    return cols
+
+
+def _column_stream(cache, fields, batch_size, workers, max_pending):
+    init_args = (tuple(fields), cache._intern) + _worker_args(cache)
+
+    def raw_batches():
+        pos = None
+        while True:
+            batch, pos = cache._scan_raw(pos, limit=batch_size)
+            if len(batch) > 0:
+                yield batch
+            if pos is None:
+                break
+
+    if workers == 0:
+        _init_worker(*init_args)
+        yield from map(_batch2columns, raw_batches())
+        return
+
+    workers = workers or os.cpu_count()
+    max_pending = max_pending or 2*workers
+
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_init_worker,
+                             initargs=init_args) as pool:
+        pending = deque()
+
+        for batch in raw_batches():
+            intern = cache._intern
+            if intern is not None:
+                intern.refresh()  # worker copies can not load new entries themselves
+            pending.append(pool.submit(_batch2columns, batch, intern))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+
+def export_batches(cache,
+                   fields=DEFAULT_FIELDS,
+                   batch_size=10000,
+                   workers=None,
+                   max_pending=None,
+                   schema=None):
+    """Stream cache contents as ``pyarrow.RecordBatch`` objects, one row per dataset.
+
+    :cache: Path or opened cache
+    :fields: List of columns to extract: id, product, time, uris, extent, crs,
+    ``doc:dotted.path`` for a value from the metadata document, or any search
+    field of the metadata type (e.g. cloud_cover)
+    :batch_size int: Number of datasets per record batch
+    :workers int: Number of decode processes, 0 to decode in this process
+    :max_pending int: Maximum number of batches in flight, bounds memory use
+    :schema: Dictionary {column_name: pyarrow.DataType} overriding column types
+
+    Column types come from the search field types of the metadata types, a
+    ``doc:`` column uses the type of the search field with the same offset.
+    Other columns are stored as strings, with JSON for non string values.
+    """
+    import pyarrow as pa
+
+    if isinstance(cache, str):
+        cache = open_ro(cache)
+
+    types = dict(_column_types(fields, cache.products))
+    for name, t in (schema or {}).items():
+        if name not in types:
+            raise ValueError('Schema column is not exported: ' + name)
+        types[name] = t
+    as_str = [name for name, t in types.items() if t is None]
+    schema = pa.schema([(name, pa.string() if t is None else t) for name, t in types.items()])
+
+    for cols in _column_stream(cache, fields, batch_size, workers, max_pending):
+        for name in as_str:
+            cols[name] = [_to_str(v) for v in cols[name]]
+        yield pa.RecordBatch.from_pydict(cols, schema=schema)
+
+
+def export_parquet(cache, fname,
+                   fields=DEFAULT_FIELDS,
+                   batch_size=10000,
+                   workers=None,
+                   compression='zstd',
+                   schema=None):
+    """Write cache contents to a Parquet file, see ``export_batches`` for parameters.
+
+    Returns number of rows written.
+    """
+    import pyarrow.parquet as pq
+
+    n = 0
+    writer = None
+    try:
+        for rb in export_batches(cache, fields=fields, batch_size=batch_size,
+                                 workers=workers, schema=schema):
+            if writer is None:
+                writer = pq.ParquetWriter(fname, rb.schema, compression=compression)
+            writer.write_batch(rb)
+            n += rb.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return n
+
+
+def test_export(tmp_path):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from .. import create_cache
+    from .synthetic import gen_datasets
+
+    dss = sorted(gen_datasets(60), key=lambda ds: ds.id.bytes)
+    for ds in dss[:-5]:
+        del ds.metadata_doc['gqa']  # no values in the first batches
+
+    path = str(tmp_path/'e.db')
+    cache = create_cache(path)
+    cache.bulk_save(dss)
+    cache.sync()
+
+    fields = DEFAULT_FIELDS + ('cloud_cover', 'lat', 'doc:gqa.cloud_cover', 'doc:gqa.ref_source', 'doc:image')
+    expect = [ds.metadata_doc.get('gqa', {}).get('cloud_cover') for ds in dss]
+
+    tables = [pa.Table.from_batches(list(export_batches(cache, fields=fields, batch_size=10, workers=workers)))
+              for workers in (0, 2)]
+    assert tables[0].equals(tables[1])
+
+    t = tables[0]
+    assert t.column('id').to_pylist() == [str(ds.id) for ds in dss]
+    assert t.column('cloud_cover').to_pylist() == expect
+    assert t.column('gqa.cloud_cover').to_pylist() == expect
+    assert t.schema.field('cloud_cover').type == pa.float64()
+    assert t.schema.field('lat').type == pa.struct([('begin', pa.float64()), ('end', pa.float64())])
+    assert t.schema.field('gqa.ref_source').type == pa.string()
+    assert isinstance(t.column('image').to_pylist()[0], str)
+
+    fname = str(tmp_path/'e.parquet')
+    assert export_parquet(cache, fname, fields=('id', 'doc:gqa.cep90'), batch_size=10,
+                          workers=0, schema={'gqa.cep90': pa.float32()}) == len(dss)
+    t = pq.read_table(fname)
+    assert t.schema.field('gqa.cep90').type == pa.float32()
+    assert t.column('gqa.cep90').null_count == len(dss) - 5
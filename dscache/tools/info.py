@@ -0,0 +1,181 @@
+""" Inspect cache contents and storage statistics
+"""
+import json
+import random
+from types import SimpleNamespace
+
+DB_NAMES = ('info', 'groups', 'ds', 'udata', 'tombstones')
+
+
+def _sample_records(tr, n, seed=0):
+    """ Sample records by seeking to random keys, uniform for UUID keys
+    """
+    rng = random.Random(seed)
+    cursor = tr.cursor()
+    for _ in range(n):
+        if not cursor.set_range(rng.getrandbits(128).to_bytes(16, 'big')):
+            cursor.first()
+        yield cursor.value()
+
+
+def _product_stats(cache, sample=None, seed=0):
+    stats = {}
+    decomp = cache._decomp
+    intern = cache._intern
+
+    with cache._dbs.main.begin(cache._dbs.ds, buffers=True) as tr:
+        total = tr.stat(cache._dbs.ds)['entries']
+        if sample is not None and sample < total:
+            records = _sample_records(tr, sample, seed=seed)
+            n = sample
+        else:
+            records = (v for _, v in tr.cursor())
+            n = total
+
+        for d in records:
+            raw = decomp.decompress(d)
+            product = json.loads(raw)['product']
+            if intern is not None:
+                product = intern.products.strings[product]
+            st = stats.get(product)
+            if st is None:
+                st = stats[product] = [0, 0, 0]
+            st[0] += 1
+            st[1] += len(d)
+            st[2] += len(raw)
+
+    scale = total/n if n > 0 else 0
+    return {p: SimpleNamespace(count=int(round(c*scale)),
+                               bytes_compressed=int(round(nc*scale)),
+                               bytes_raw=int(round(nr*scale)),
+                               ratio=nr/nc if nc else None)
+            for p, (c, nc, nr) in sorted(stats.items())}
+
+
+def _percentile(vv, q):
+    return vv[min(len(vv) - 1, (len(vv)*q)//100)]
+
+
+def _group_prefix(cache, name):
+    if cache.typed_keys:
+        name = cache._group_name(name)
+        return str(name[0]) if isinstance(name, tuple) else ''
+    return name.split(b'/', 1)[0].decode('utf8', 'replace') if b'/' in name else ''
+
+
+def _group_stats(cache):
+    sizes = {}
+    for name, n in cache.groups(raw=True):
+        sizes.setdefault(_group_prefix(cache, name), []).append(n)
+
+    out = {}
+    for prefix, nn in sorted(sizes.items()):
+        nn = sorted(nn)
+        out[prefix] = SimpleNamespace(count=len(nn),
+                                      total=sum(nn),
+                                      min=nn[0],
+                                      p50=_percentile(nn, 50),
+                                      p90=_percentile(nn, 90),
+                                      max=nn[-1],
+                                      mean=sum(nn)/len(nn))
+    return out
+
+
+def _lmdb_stats(cache, map_size=None):
+    env = cache._dbs.main
+    out = {}
+    with env.begin() as tr:
+        for name in DB_NAMES:
+            db = getattr(cache._dbs, name)
+            if db is not None:
+                out[name] = tr.stat(db)
+
+    info = env.info()
+    psize = env.stat()['psize']
+    used = (info['last_pgno'] + 1)*psize
+    map_size = info['map_size'] if map_size is None else map_size
+
+    return out, SimpleNamespace(map_size=map_size,
+                                page_size=psize,
+                                used=used,
+                                free=map_size - used)
+
+
+def cache_info(cache, sample=None, seed=0, map_size=None):
+    """Collect statistics about a (non-sharded) cache.
+
+    :sample int: Estimate per product numbers from this many randomly chosen
+    records instead of decompressing every record.
+
+    :map_size int: Compute free space relative to this size instead of the
+    current map size, useful for readonly opens where map size equals file size.
+
+    Returns SimpleNamespace with:
+      count: number of datasets
+      sampled: number of sampled records, or None if full scan was done
+      products: {name: (count, bytes_compressed, bytes_raw, ratio)}
+      groups: {prefix: (count, total, min, p50, p90, max, mean)}, prefix is
+              group name up to the first '/', or first element of typed names
+      dbs: {sub_db_name: LMDB stat dictionary}
+      space: (map_size, page_size, used, free) in bytes
+    """
+    dbs, space = _lmdb_stats(cache, map_size=map_size)
+    count = dbs['ds']['entries']
+
+    return SimpleNamespace(count=count,
+                           sampled=sample if sample is not None and sample < count else None,
+                           products=_product_stats(cache, sample=sample, seed=seed),
+                           groups=_group_stats(cache),
+                           dbs=dbs,
+                           space=space)
+
+
+def _sz(n):
+    if n < 1024:
+        return '{:d}b'.format(n)
+    for unit in ('Kb', 'Mb', 'Gb'):
+        n /= 1024
+        if n < 1024 or unit == 'Gb':
+            return '{:.1f}{}'.format(n, unit)
+
+
+def info2dict(info):
+    """ Convert to plain dictionaries, suitable for JSON output
+    """
+    if isinstance(info, SimpleNamespace):
+        info = vars(info)
+    if isinstance(info, dict):
+        return {k: info2dict(v) for k, v in info.items()}
+    return info
+
+
+def info2text(info):
+    """ Human readable report
+    """
+    lines = ['Datasets: {:,d}{}'.format(info.count,
+                                          '' if info.sampled is None else
+                                          ' (per product numbers estimated from {:,d} samples)'.format(
+                                              info.sampled))]
+
+    lines.append('Products:')
+    for name, p in info.products.items():
+        lines.append('  {:30s} {:>12,d} {:>10s} -> {:>10s} x{:.2f}'.format(
+            name, p.count, _sz(p.bytes_raw), _sz(p.bytes_compressed), p.ratio or 0))
+
+    lines.append('Groups:')
+    for prefix, g in info.groups.items():
+        lines.append('  {:30s} {:>8,d} groups, {:,d} members, size min/p50/p90/max: {:d}/{:d}/{:d}/{:d}'.format(
+            prefix or '(no prefix)', g.count, g.total, g.min, g.p50, g.p90, g.max))
+
+    lines.append('LMDB:')
+    for name, st in info.dbs.items():
+        pages = st['branch_pages'] + st['leaf_pages'] + st['overflow_pages']
+        lines.append('  {:10s} entries:{:>12,d} depth:{:d} pages:{:,d} (branch:{:,d} leaf:{:,d} overflow:{:,d})'.format(
+            name, st['entries'], st['depth'], pages,
+            st['branch_pages'], st['leaf_pages'], st['overflow_pages']))
+
+    sp = info.space
+    lines.append('Space: used {} of {} map, {} free (page size {:d})'.format(
+        _sz(sp.used), _sz(sp.map_size), _sz(sp.free), sp.page_size))
+
+    return '\n'.join(lines)
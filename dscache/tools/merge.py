@@ -0,0 +1,266 @@
+""" Merge several dataset caches into one
+"""
+import heapq
+import itertools
+import json
+from types import SimpleNamespace
+import toolz
+
+from .. import create_cache, open_ro
+from ..dscache import doc2bytes
+from ..sharded import ShardedDatasetCache
+
+
+def _expand_sources(inputs):
+    """ Turn list of paths/caches into list of plain (non-sharded) caches
+    """
+    out = []
+    for src in inputs:
+        if isinstance(src, str):
+            src = open_ro(src)
+        if isinstance(src, ShardedDatasetCache):
+            out.extend(shard for shard in src.shards if shard is not None)
+        else:
+            out.append(src)
+    return out
+
+
+def _sorted_kv(caches, db_name):
+    """ Merge sorted streams of (key, source_index, value) from a given sub-db of
+    every cache. Read transactions stay open until the stream is exhausted.
+    """
+    def stream(idx, cache):
+        dbs = cache._dbs
+        with dbs.main.begin(getattr(dbs, db_name), write=False) as tr:
+            for k, v in tr.cursor():
+                yield (k, idx, v)
+
+    return heapq.merge(*[stream(idx, cache) for idx, cache in enumerate(caches)])
+
+
+def _put_sorted(dst, db_name, kvs, append, chunk_size, overwrite=True):
+    """ Write sorted (key, value) stream in chunks, using append mode when possible.
+    """
+    dbs = dst._dbs
+    n = 0
+    for chunk in toolz.partition_all(chunk_size, kvs):
+        with dst._write_txn(getattr(dbs, db_name)) as tr:
+            _, added = tr.cursor().putmulti(chunk, append=append, overwrite=overwrite)
+            n += added
+    return n
+
+
+def _merge_group_data(parts):
+    """ Concatenate uuid lists removing duplicates, keeping first occurrence order
+    """
+    if len(parts) == 1:
+        return parts[0]
+
+    seen = set()
+    out = bytearray()
+    for data in parts:
+        for i in range(0, len(data), 16):
+            k = data[i:i+16]
+            if k not in seen:
+                seen.add(k)
+                out += k
+    return bytes(out)
+
+
+def _copy_tombstones(srcs, dst):
+    """ Copy tombstones of all inputs into output, returns number of tombstones copied
+    """
+    n = 0
+    for src in srcs:
+        dbs = src._dbs
+        if dbs.tombstones is None:
+            continue
+        with dbs.main.begin(dbs.tombstones) as tr_src, dst._write_txn(dst._dbs.tombstones) as tr:
+            for k, _ in tr_src.cursor():
+                tr.put(k, b'')
+                n += 1
+    return n
+
+
+def merge_caches(output, inputs,
+                 complevel=6,
+                 zdict=None,
+                 max_db_sz=None,
+                 truncate=False,
+                 chunk_size=10000,
+                 intern=None):
+    """Union datasets, products, metadata types and groups of several caches into one.
+
+    Records are visited in key order across all inputs and written in sorted
+    append mode. When input compression dictionary matches the output one,
+    compressed records are copied without recompression, otherwise they are
+    decompressed and compressed again. When the same dataset is present in
+    several inputs the first input wins. Groups with the same name are merged,
+    duplicate members are dropped, so are members deleted from their input
+    (see DatasetCache.bulk_delete). When output already exists its datasets
+    and groups are kept as if it was the first input. All inputs must use the
+    same group name encoding (see ``typed_keys`` in create_cache), output
+    uses it too.
+
+    :output str: Path to the output cache
+    :inputs: Paths or opened caches, sharded caches are expanded into shards
+    :zdict bytes: Compression dictionary for output, defaults to the one used by the first input
+    :intern bool: Intern product names and uri prefixes in the output,
+    defaults to what the first input does. Interned records are never
+    copied without recompression, since reference ids are local to a cache.
+
+    Returns SimpleNamespace with statistics, ``datasets`` counts records
+    written, ``existing`` records skipped because output already had them
+    and ``duplicates`` records present in more than one input.
+    """
+    srcs = _expand_sources(inputs)
+    if len(srcs) == 0:
+        raise ValueError('Need at least one input')
+
+    if zdict is None:
+        zdict = srcs[0]._zdict
+
+    if intern is None:
+        intern = srcs[0]._intern is not None
+
+    keyfmt = srcs[0]._keyfmt
+    if any(src._keyfmt != keyfmt for src in srcs):
+        raise ValueError('Inputs use different group name encodings')
+
+    dst = create_cache(output,
+                       complevel=complevel,
+                       zdict=zdict,
+                       max_db_sz=max_db_sz,
+                       truncate=truncate,
+                       typed_keys=keyfmt is not None,
+                       intern=intern,
+                       intern_uri_depth=2 if srcs[0]._intern is None else srcs[0]._intern.uri_depth)
+
+    if dst._zdict != zdict:
+        raise ValueError('Output exists and uses a different compression dictionary')
+
+    if dst._keyfmt != keyfmt:
+        raise ValueError('Output exists and uses a different group name encoding')
+
+    if (dst._intern is not None) != intern:
+        raise ValueError('Output exists and uses a different interning mode')
+
+    stats = SimpleNamespace(datasets=0,
+                            existing=0,
+                            duplicates=0,
+                            copied=0,
+                            recompressed=0,
+                            groups=0,
+                            groups_compacted=0,
+                            products=0)
+
+    passthrough = [src._zdict == zdict and src._intern is None and dst._intern is None
+                   for src in srcs]
+
+    for src in srcs:
+        for name, product in src.products.items():
+            if name not in dst.products:
+                dst.products[name] = product
+
+    def ds_records(empty):
+        dbs = dst._dbs
+        prev = None
+        for k, idx, v in _sorted_kv(srcs, 'ds'):
+            if k == prev:
+                stats.duplicates += 1
+                continue
+            prev = k
+
+            if not empty:
+                with dbs.main.begin(dbs.ds) as tr:
+                    if tr.get(k) is not None:
+                        stats.existing += 1
+                        continue
+
+            src = srcs[idx]
+            if passthrough[idx]:
+                stats.copied += 1
+            elif src._intern is None and dst._intern is None:
+                stats.recompressed += 1
+                v = dst._comp.compress(src._decomp.decompress(v))
+            else:
+                stats.recompressed += 1
+                doc = json.loads(src._decomp.decompress(v))
+                if src._intern is not None:
+                    src._intern.expand(doc)
+                _, v = doc2bytes(doc, dst._intern)
+                v = dst._comp.compress(v)
+            yield (k, v)
+
+    def group_records(empty):
+        dbs = dst._dbs
+        for k, items in itertools.groupby(_sorted_kv(srcs, 'groups'), key=lambda x: x[0]):
+            parts = [v for _, _, v in items]
+            if not empty:
+                with dbs.main.begin(dbs.groups) as tr:
+                    existing = tr.get(k)
+                if existing is not None:
+                    parts.insert(0, existing)
+            yield (k, _merge_group_data(parts))
+
+    empty = dst.count == 0
+    stats.datasets = _put_sorted(dst, 'ds', ds_records(empty), empty, chunk_size, overwrite=False)
+
+    empty = len(dst.groups(raw=True)) == 0
+    stats.groups = _put_sorted(dst, 'groups', group_records(empty), empty, chunk_size)
+
+    if _copy_tombstones(srcs, dst) > 0:
+        stats.groups_compacted = dst.compact_groups().groups
+
+    stats.products = len(dst.products)
+    dst.sync()
+
+    return stats
+
+
+def test_merge(tmp_path):
+    from uuid import UUID
+    from .. import train_dictionary
+    from .synthetic import gen_datasets
+
+    dss = list(gen_datasets(300))
+    ids = [ds.id for ds in dss]
+
+    def mk(name, dss, groups, zdict=None):
+        cache = create_cache(str(tmp_path/name), zdict=zdict)
+        cache.bulk_save(dss)
+        for g, uu in groups.items():
+            cache.put_group(g, uu)
+        cache.sync()
+        return cache
+
+    zdict = train_dictionary(dss[:200], 4*1024)
+    a = mk('a.db', dss[:100], {'g': ids[:10]}, zdict=zdict)
+    b = mk('b.db', dss[50:150], {'g': ids[5:15] + ids[50:55], 'h': ids[60:70]})
+
+    rr = merge_caches(str(tmp_path/'o.db'), [a, b])
+    assert (rr.datasets, rr.duplicates, rr.copied, rr.recompressed) == (150, 50, 100, 50)
+    assert rr.groups == 2
+
+    o = open_ro(str(tmp_path/'o.db'))
+    assert o._zdict == zdict
+    assert o.get_group('g') == ids[:15] + ids[50:55]
+    assert o.get_group('h') == ids[60:70]
+    assert [ds.id for ds in o.get_all()] == sorted(ids[:150], key=lambda u: u.bytes)
+    assert o.get(ids[120]).metadata_doc == dss[120].metadata_doc
+    del o
+
+    # merge into existing non-empty output keeps its groups
+    c = mk('c.db', dss[150:], {'g': ids[150:160], 'k': ids[200:210]}, zdict=zdict)
+    rr = merge_caches(str(tmp_path/'o.db'), [c])
+    assert (rr.datasets, rr.existing, rr.copied) == (150, 0, 150)
+
+    rr = merge_caches(str(tmp_path/'o.db'), [c])
+    assert (rr.datasets, rr.existing, rr.copied, rr.recompressed) == (0, 150, 0, 0)
+
+    o = open_ro(str(tmp_path/'o.db'))
+    assert o.count == 300
+    assert o.get_group('g') == ids[:15] + ids[50:55] + ids[150:160]
+    assert o.get_group('h') == ids[60:70]
+    assert o.get_group('k') == ids[200:210]
+    assert isinstance(o.get_group('k')[0], UUID)
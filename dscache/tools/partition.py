@@ -0,0 +1,305 @@
+""" Split cache into independent partitions for distributed processing
+
+Partitions are plain picklable descriptors, every worker opens the cache file
+locally and decodes only its own part.
+
+LMDB environments can only be opened once per process, so caches are opened
+through ``open_shared``, which keeps one readonly instance per file and lets
+several threads (e.g. dask threaded scheduler) read partitions of the same file.
+Records are decoded with per thread decompressors, since a shared cache
+instance is used from many threads.
+"""
+import heapq
+import threading
+from pathlib import Path
+from types import SimpleNamespace
+from uuid import UUID
+
+from .. import open_ro
+from ..dscache import _decode_dss
+from ..sharded import ShardedDatasetCache, is_sharded, load_manifest, _shard_paths
+
+
+_SHARED = {}
+_SHARED_LOCK = threading.Lock()
+
+
+def open_shared(path):
+    """Open cache in readonly mode, reusing files already opened by this
+    function in this process. Use this to keep a cache open while also
+    computing or reading partitions of it.
+
+    Sharded caches are assembled from shared instances of every shard file
+    present on disk.
+    """
+    if is_sharded(path):
+        manifest = load_manifest(path)
+        return ShardedDatasetCache(path, manifest,
+                                   [open_shared(p) if p.exists() else None
+                                    for p in _shard_paths(path, manifest)])
+
+    key = str(Path(path).absolute())
+    with _SHARED_LOCK:
+        cache = _SHARED.get(key)
+        if cache is None:
+            cache = _SHARED[key] = open_ro(str(path))
+    return cache
+
+
+def release_shared(path):
+    """Close files opened by ``open_shared``, needed before opening the same
+    file for writing or forking worker processes. Instances returned earlier
+    for this path must not be used after this.
+    """
+    for p in _cache_files(path):
+        with _SHARED_LOCK:
+            cache = _SHARED.pop(str(Path(p).absolute()), None)
+        if cache is not None:
+            cache._dbs.main.close()
+
+
+def _cache_files(path):
+    """ List of plain cache files making up a cache (one unless sharded)
+    """
+    if is_sharded(path):
+        return [str(Path(path)/name) for name in load_manifest(path)['shards']
+                if (Path(path)/name).exists()]
+    return [str(path)]
+
+
+def _key_stats(path):
+    """ Count, first and last key of a plain cache
+    """
+    cache = open_shared(path)
+    with cache._dbs.main.begin(cache._dbs.ds) as tr:
+        n = tr.stat(cache._dbs.ds)['entries']
+        if n == 0:
+            return 0, None, None
+        cursor = tr.cursor()
+        cursor.first()
+        first = cursor.key()
+        cursor.last()
+        last = cursor.key()
+    return n, first, last
+
+
+def _uniform_bounds(first, last, n):
+    """ Split key range assuming keys are uniformly distributed, which is true for UUIDs
+    """
+    a, b = [int.from_bytes(k, 'big') for k in (first, last)]
+    sz = max(len(first), len(last))
+    return [(a + ((b - a)*i)//n).to_bytes(sz, 'big') for i in range(1, n)]
+
+
+def _exact_bounds(path, count, n):
+    """ Split key range into parts with equal number of records (scans all keys)
+    """
+    marks = set((i*count)//n for i in range(1, n))
+    cache = open_shared(path)
+    bounds = []
+    with cache._dbs.main.begin(cache._dbs.ds) as tr:
+        for i, k in enumerate(tr.cursor().iternext(keys=True, values=False)):
+            if i in marks:
+                bounds.append(k)
+    return bounds
+
+
+def key_partitions(path, npartitions, exact=False):
+    """Split datasets in a cache into ``npartitions`` key ranges.
+
+    :path str: Cache file, or folder of a sharded cache
+    :npartitions int: Desired number of partitions (at least one per non-empty shard)
+    :exact bool: Scan all keys to get equally sized partitions, default is to
+    assume uniform key distribution, which is the case for UUIDs
+
+    Returns list of SimpleNamespace(kind='keys', path, start, stop, count), where
+    count is an estimate unless ``exact=True``.
+    """
+    assert npartitions > 0
+
+    files = [(p,) + _key_stats(p) for p in _cache_files(path)]
+    files = [f for f in files if f[1] > 0]
+    total = sum(f[1] for f in files)
+
+    parts = []
+    for p, count, first, last in files:
+        n = min(count, max(1, round(npartitions*count/total)))
+        bounds = _exact_bounds(p, count, n) if exact else _uniform_bounds(first, last, n)
+        edges = [None] + bounds + [None]
+
+        for start, stop in zip(edges[:-1], edges[1:]):
+            parts.append(SimpleNamespace(kind='keys',
+                                         path=p,
+                                         start=start,
+                                         stop=stop,
+                                         count=count//n))
+    return parts
+
+
+def group_partitions(path, npartitions, groups=None):
+    """Split groups into ``npartitions`` lists with roughly equal total number of datasets.
+
+    :path str: Cache file, or folder of a sharded cache
+    :groups: List of group names, or prefix string, default is all groups
+
+    Returns list of SimpleNamespace(kind='groups', path, groups, count)
+    """
+    assert npartitions > 0
+
+    cache = open_shared(path)
+    if groups is None or isinstance(groups, str):
+        sizes = cache.groups(prefix=groups)
+    else:
+        sizes = dict(cache.groups())
+        sizes = [(g, sizes.get(g, 0)) for g in groups]
+
+    bins = [(0, i, []) for i in range(min(npartitions, len(sizes)))]
+    for g, n in sorted(sizes, key=lambda x: -x[1]):
+        count, i, gg = heapq.heappop(bins)
+        gg.append(g)
+        heapq.heappush(bins, (count + n, i, gg))
+
+    return [SimpleNamespace(kind='groups',
+                            path=str(path),
+                            groups=gg,
+                            count=count)
+            for count, _, gg in sorted(bins, key=lambda x: x[1])]
+
+
+def _read_keys(cache, start, stop, products, batch_size=1000):
+    """ Datasets of a plain cache with start <= key < stop
+    """
+    dbs = cache._dbs
+    with dbs.main.begin(dbs.ds) as tr:
+        cursor = tr.cursor()
+        ok = cursor.first() if start is None else cursor.set_range(start)
+        batch = []
+        while ok:
+            if stop is not None and cursor.key() >= stop:
+                break
+            batch.append(cursor.value())
+            if len(batch) >= batch_size:
+                yield from _decode_dss(cache._zdict, products, batch, cache._intern)
+                batch = []
+            ok = cursor.next()
+
+    yield from _decode_dss(cache._zdict, products, batch, cache._intern)
+
+
+def _read_group(cache, name, products):
+    """ Datasets of a group, skipping members deleted after the group was read
+    """
+    uu = cache._get_group_raw(name)
+    if uu is None:
+        raise ValueError('No such group: %s' % (name,))
+    if len(uu) & 0xF:
+        raise ValueError('Wrong data size for group %s' % (name,))
+
+    keys = [uu[i:i+16] for i in range(0, len(uu), 16)]
+    batch = cache._get_raw_many(keys)
+    missing = [k for k, d in zip(keys, batch) if d is None]
+    if missing:
+        dead = cache._tombstoned(missing)
+        for k in missing:
+            if k not in dead:
+                raise ValueError('Missing dataset for %s' % (str(UUID(bytes=k))))
+        batch = [d for d in batch if d is not None]
+
+    return _decode_dss(cache._zdict, products, batch, cache._intern)
+
+
+def read_partition(part, products=None):
+    """Decode one partition, normally called on a worker, safe to call from
+    several threads at once.
+
+    For key partitions yields datasets, for group partitions yields tuples
+    of (group_name, [Dataset]).
+
+    :products: Product dictionary override, see ``open_ro``
+    """
+    cache = open_shared(part.path)
+    products = cache.products if products is None else products
+
+    if part.kind == 'keys':
+        yield from _read_keys(cache, part.start, part.stop, products)
+    elif part.kind == 'groups':
+        for g in part.groups:
+            yield (g, _read_group(cache, g, products))
+    else:
+        raise ValueError('Unknown partition kind: {}'.format(part.kind))
+
+
+def _load_partition(part, products):
+    return list(read_partition(part, products))
+
+
+def to_dask_bag(path, npartitions, groups=None, products=None, exact=False):
+    """Construct ``dask.bag.Bag`` of datasets, or of (group_name, [Dataset]) if
+    ``groups`` is supplied (list of names or a prefix string).
+
+    Each bag partition opens the cache file on the worker, so the file has to
+    be available at the same path on all workers.
+    """
+    import dask.bag
+    from dask import delayed
+
+    if groups is None:
+        parts = key_partitions(path, npartitions, exact=exact)
+    else:
+        parts = group_partitions(path, npartitions, groups=groups)
+
+    load = delayed(_load_partition, pure=True)
+    return dask.bag.from_delayed([load(part, products) for part in parts])
+
+
+def test_concurrent_partitions(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+    from .. import create_cache, train_dictionary
+    from .synthetic import gen_datasets
+
+    path = str(tmp_path/'part.db')
+    dss = list(gen_datasets(3000))
+    cache = create_cache(path, zdict=train_dictionary(dss[:500], 8*1024))
+    cache.bulk_save(dss)
+    cache.put_group('a', [ds.id for ds in dss[:10]])
+    cache.put_group('b', [ds.id for ds in dss[10:30]])
+    del cache
+
+    reader = open_shared(path)
+    parts = key_partitions(path, 16)
+    assert len(parts) == 16
+
+    with ThreadPoolExecutor(16) as pool:
+        loaded = list(pool.map(lambda part: _load_partition(part, None), parts))
+
+    assert sorted(ds.id for dss_ in loaded for ds in dss_) == sorted(ds.id for ds in dss)
+    assert reader.count == len(dss)
+
+    parts = group_partitions(path, 2)
+    with ThreadPoolExecutor(2) as pool:
+        loaded = dict(g for gg in pool.map(lambda part: _load_partition(part, None), parts) for g in gg)
+    assert {g: len(v) for g, v in loaded.items()} == {'a': 10, 'b': 20}
+    release_shared(path)
+
+
+def test_sharded_partitions(tmp_path):
+    from .. import create_sharded_cache
+    from .synthetic import gen_datasets, mk_products
+
+    path = tmp_path/'sharded'
+    dss = list(gen_datasets(100))
+    cache = create_sharded_cache(path, nshards=4)
+    cache.bulk_save(dss)
+    cache.put_group('a', [ds.id for ds in dss[:40]])
+    cache.sync()
+    del cache
+
+    (gpart,) = group_partitions(path, 1)
+    parts = key_partitions(path, 4)
+    assert sum(len(_load_partition(part, None)) for part in parts) == len(dss)
+
+    products = mk_products()
+    ((name, members),) = _load_partition(gpart, products)
+    assert name == 'a' and len(members) == 40
+    assert all(ds.type is products[ds.type.name] for ds in members)
+    release_shared(path)
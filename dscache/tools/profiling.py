@@ -1,9 +1,29 @@
 from types import SimpleNamespace
 import timeit
+from ..metrics import diff_snapshots
+
+
+def _stages2s(stats, total):
+    """ Per-stage time breakdown from a stats snapshot difference
+    """
+    lines = []
+    for name in ('decompress', 'json_parse', 'dataset_construct', 'compress', 'commit'):
+        t = stats['timers'].get(name, {})
+        if t.get('count', 0) == 0:
+            continue
+        lines.append('  {:18s}: {:6.3f} sec {:5.1f}% ({:,d})'.format(
+            name, t['total'], 100*t['total']/total, t['count']))
+
+    cc = stats['counters']
+    if cc.get('bytes_read'):
+        lines.append('  {:18s}: {:,d} -> {:,d} bytes'.format('decompressed',
+                                                            cc['bytes_read'],
+                                                            cc['bytes_decompressed']))
+    return '\n'.join(lines)
 
 
 def _rr2s(r):
-    return '''
+    txt = '''
 Count: {r.count:,d}
        {fps:.1f} per second
 Total: {r.total:6.3f} sec
@@ -12,14 +32,26 @@ TTFB : {r.ttfb:6.3f} sec
 ..
 '''.format(r=r, fps=r.count/r.total).strip()
 
+    if r.stages is not None:
+        txt += '\nStages:\n' + _stages2s(r.stages, r.total)
+
+    return txt
 
-def ds_stream_test_func(dss, get_uuid=None):
+
+def ds_stream_test_func(dss, get_uuid=None, stats=None):
+    """ Time consumption of a dataset stream.
+
+    :stats CacheStats: When supplied, report includes per-stage breakdown of
+    time spent inside the cache during the stream (see DatasetCache.enable_stats)
+    """
     def default_get_uuid(ds):
         return ds.id
 
     if get_uuid is None:
         get_uuid = default_get_uuid
 
+    s0 = None if stats is None else stats.snapshot()
+
     timer = timeit.default_timer
     uu = 0
     count = 0
@@ -36,6 +68,7 @@ def ds_stream_test_func(dss, get_uuid=None):
                          count=count,
                          ttfb=t0-t00,
                          total=t_end-t00,
+                         stages=None if stats is None else diff_snapshots(s0, stats.snapshot()),
                          text='')
     rr.text = _rr2s(rr)
     return rr
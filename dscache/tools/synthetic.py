@@ -0,0 +1,177 @@
+""" Synthetic EO dataset documents and products, no datacube database required
+
+Documents follow the layout of Landsat scenes indexed with the ``eo``
+metadata type, with footprints spread over the Australian Albers grid.
+"""
+import random
+import datetime
+import uuid
+
+EO_METADATA_DOC = {
+    'name': 'eo',
+    'description': 'Earth Observation datasets (synthetic)',
+    'dataset': {
+        'id': ['id'],
+        'creation_dt': ['creation_dt'],
+        'label': ['ga_label'],
+        'measurements': ['image', 'bands'],
+        'grid_spatial': ['grid_spatial', 'projection'],
+        'format': ['format', 'name'],
+        'sources': ['lineage', 'source_datasets'],
+        'search_fields': {
+            'platform': {'description': 'Platform code',
+                         'offset': ['platform', 'code']},
+            'instrument': {'description': 'Instrument name',
+                           'offset': ['instrument', 'name']},
+            'product_type': {'description': 'Product code',
+                             'offset': ['product_type']},
+            'cloud_cover': {'description': 'Cloud cover percentage',
+                            'type': 'double',
+                            'offset': ['gqa', 'cloud_cover']},
+            'lat': {'description': 'Latitude range',
+                    'type': 'double-range',
+                    'min_offset': [['extent', 'coord', 'ur', 'lat'],
+                                   ['extent', 'coord', 'lr', 'lat'],
+                                   ['extent', 'coord', 'ul', 'lat'],
+                                   ['extent', 'coord', 'll', 'lat']],
+                    'max_offset': [['extent', 'coord', 'ur', 'lat'],
+                                   ['extent', 'coord', 'lr', 'lat'],
+                                   ['extent', 'coord', 'ul', 'lat'],
+                                   ['extent', 'coord', 'll', 'lat']]},
+            'lon': {'description': 'Longitude range',
+                    'type': 'double-range',
+                    'min_offset': [['extent', 'coord', 'ul', 'lon'],
+                                   ['extent', 'coord', 'll', 'lon']],
+                    'max_offset': [['extent', 'coord', 'ur', 'lon'],
+                                   ['extent', 'coord', 'lr', 'lon']]},
+            'time': {'description': 'Acquisition time',
+                     'type': 'datetime-range',
+                     'min_offset': [['extent', 'from_dt']],
+                     'max_offset': [['extent', 'to_dt']]},
+        },
+    },
+}
+
+LS_BANDS = ('blue', 'green', 'red', 'nir', 'swir1', 'swir2')
+
+PLATFORMS = {'ls5': ('LANDSAT_5', 'TM', 'LT5'),
+             'ls7': ('LANDSAT_7', 'ETM', 'LE7'),
+             'ls8': ('LANDSAT_8', 'OLI_TIRS', 'LC8')}
+
+
+def mk_product_doc(name, platform='ls8', bands=LS_BANDS):
+    platform_code, instrument, _ = PLATFORMS[platform]
+    return {
+        'name': name,
+        'description': 'Synthetic {} surface reflectance'.format(platform_code),
+        'metadata_type': 'eo',
+        'metadata': {'product_type': name,
+                     'platform': {'code': platform_code},
+                     'instrument': {'name': instrument},
+                     'format': {'name': 'GeoTIFF'}},
+        'measurements': [{'name': b,
+                          'dtype': 'int16',
+                          'nodata': -999,
+                          'units': '1'} for b in bands],
+    }
+
+
+def mk_products(names=('ls5_nbar_scene', 'ls7_nbar_scene', 'ls8_nbar_scene')):
+    """ Construct dictionary of products, platform is taken from the name prefix.
+    """
+    from datacube.model import metadata_from_doc, DatasetType
+
+    mt = metadata_from_doc(EO_METADATA_DOC)
+    return {name: DatasetType(mt, mk_product_doc(name, platform=name[:3]))
+            for name in names}
+
+
+def _footprint(rng, path, row):
+    """ Approximate Landsat scene footprint in Albers and lon/lat for a given path/row
+    """
+    cx = -1_900_000 + (116 - path)*140_000 + rng.uniform(-5000, 5000)
+    cy = -1_000_000 - (row - 66)*160_000 + rng.uniform(-5000, 5000)
+    w, h = 185_000, 170_000
+
+    pts = {'ll': (cx - w/2, cy - h/2), 'lr': (cx + w/2, cy - h/2),
+           'ul': (cx - w/2, cy + h/2), 'ur': (cx + w/2, cy + h/2)}
+
+    def lonlat(x, y):
+        return {'lon': round(132 + x/95_000, 6), 'lat': round(-25.5 + (y + 2_600_000)/111_000, 6)}
+
+    geo_ref = {k: {'x': x, 'y': y} for k, (x, y) in pts.items()}
+    coord = {k: lonlat(x, y) for k, (x, y) in pts.items()}
+    valid = [[pts[k][0] + dx, pts[k][1] + dy] for k, dx, dy in (('ll', 3000, 800),
+                                                                   ('ul', 800, -3000),
+                                                                   ('ur', -3000, -800),
+                                                                   ('lr', -800, 3000))]
+    valid.append(valid[0])
+
+    return geo_ref, coord, {'type': 'Polygon', 'coordinates': [valid]}
+
+
+def mk_dataset_doc(product, rng=None, t0=datetime.datetime(2000, 1, 1)):
+    """ Generate one raw dataset document: {product, uris, metadata}.
+
+    :product: Product name, must start with one of the platform prefixes (ls5, ls7, ls8)
+    :rng: random.Random instance
+    """
+    rng = rng or random.Random()
+    platform_code, instrument, prefix = PLATFORMS[product[:3]]
+
+    path, row = rng.randint(88, 116), rng.randint(66, 91)
+    t = t0 + datetime.timedelta(days=rng.randint(0, 365*18), seconds=rng.randint(0, 86399))
+    ds_id = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+    tile_id = '{}{:03d}{:03d}{:%Y%j}LGN00'.format(prefix, path, row, t)
+    geo_ref, coord, valid = _footprint(rng, path, row)
+
+    base = 's3://dea-public-data/{}/{:03d}/{:03d}/{:%Y/%m/%d}/'.format(product, path, row, t)
+    fname = '{}_{}_{:%Y%m%d}'.format(product.upper(), tile_id, t)
+
+    doc = {
+        'id': ds_id,
+        'creation_dt': (t + datetime.timedelta(days=rng.randint(5, 60))).isoformat(),
+        'product_type': product,
+        'ga_label': fname,
+        'tile_id': tile_id,
+        'platform': {'code': platform_code},
+        'instrument': {'name': instrument},
+        'format': {'name': 'GeoTIFF'},
+        'extent': {'from_dt': t.isoformat(),
+                   'center_dt': (t + datetime.timedelta(seconds=12)).isoformat(),
+                   'to_dt': (t + datetime.timedelta(seconds=24)).isoformat(),
+                   'coord': coord},
+        'grid_spatial': {'projection': {'spatial_reference': 'EPSG:3577',
+                                        'geo_ref_points': geo_ref,
+                                        'valid_data': valid}},
+        'gqa': {'cloud_cover': round(rng.uniform(0, 100), 2),
+                'cep90': round(rng.uniform(0, 1), 4),
+                'ref_source': 'GLS_v1'},
+        'image': {'bands': {b: {'path': '{}_{}.tif'.format(fname, b.upper()), 'layer': 1}
+                            for b in LS_BANDS}},
+        'lineage': {'source_datasets': {},
+                    'algorithm': {'name': 'nbar', 'version': '4.{:d}'.format(rng.randint(0, 9))}},
+    }
+
+    return {'product': product,
+            'uris': [base + fname + '.yaml'],
+            'metadata': doc}
+
+
+def gen_raw_datasets(n, products=None, seed=0):
+    """ Generate stream of ``n`` raw dataset documents cycling through products
+    """
+    products = list(products or mk_products())
+    rng = random.Random(seed)
+
+    for i in range(n):
+        yield mk_dataset_doc(products[i % len(products)], rng=rng)
+
+
+def gen_datasets(n, products=None, seed=0):
+    """ Generate stream of ``n`` ``Dataset`` objects
+    """
+    from . import mk_raw2ds
+
+    products = products or mk_products()
+    return map(mk_raw2ds(products), gen_raw_datasets(n, products, seed=seed))
@@ -45,28 +45,95 @@ def extract_ls_path_row(ds):
     return tuple(int(s) for s in (full_id[3:6], full_id[6:9]))
 
 
-def bin_dataset_stream(gridspec, dss, persist=None):
+def _is_nested(fine, coarse, tol=1e-6):
+    """ Check if every tile of ``coarse`` grid is an exact union of tiles of ``fine`` grid
     """
+    if fine.crs != coarse.crs:
+        return False
 
-    :param gridspec: GridSpec
+    for f, c, fo, co in zip(fine.tile_size, coarse.tile_size, fine.origin, coarse.origin):
+        ratio, offset = c/f, (co - fo)/f
+        if round(ratio) < 1 or abs(ratio - round(ratio)) > tol or abs(offset - round(offset)) > tol:
+            return False
+
+    return True
+
+
+def _mk_parent_index(fine, coarse):
+    """ Construct function mapping tile index in ``fine`` grid to tile index of
+    the enclosing tile in ``coarse`` grid, using the centre of the fine tile.
+    """
+    from math import floor
+
+    (fsy, fsx), (foy, fox) = fine.tile_size, fine.origin
+    (csy, csx), (coy, cox) = coarse.tile_size, coarse.origin
+    memo = {}
+
+    def parent(idx):
+        p = memo.get(idx)
+        if p is None:
+            x = fox + (idx[0] + 0.5)*fsx
+            y = foy + (idx[1] + 0.5)*fsy
+            p = memo[idx] = (floor((x - cox)/csx), floor((y - coy)/csy))
+        return p
+
+    return parent
+
+
+def _accumulator(compact):
+    """ Returns (new, append) functions for bin member lists
+    """
+    if compact:
+        return bytearray, bytearray.extend
+    return (lambda val: [val]), list.append
+
+
+def bin_dataset_stream_multi(gridspecs, dss, persist=None, compact=False):
+    """Bin datasets into several grids in one pass over the datasets.
+
+    Grids nested inside a finer grid with the same CRS (like consecutive web
+    map zoom levels) are not intersected with dataset footprints, their tile
+    indexes are derived from tile indexes of the finest nesting grid instead.
+
+    :param gridspecs: Dictionary of GridSpec objects, keys are arbitrary
     :param dss: Sequence of datasets (can be lazy)
     :param persist: Dataset -> SomeThing mapping, defaults to keeping dataset id only
+    :param compact: Accumulate members of every cell in a ``bytearray`` of
+    concatenated 16 byte keys instead of a list, ``persist`` then has to
+    return bytes (defaults to ``ds.id.bytes``). This uses 16 bytes per
+    member instead of over 100, and ``cell.dss`` can be passed to
+    ``put_group`` directly.
+
+    Returns dictionary with the same keys as ``gridspecs``, values are
+    dictionaries of cells as returned by ``bin_dataset_stream``.
     """
-    cells = {}
-    geobox_cache = {}
-
     def default_persist(ds):
-        return ds.id
+        return ds.id.bytes if compact else ds.id
 
-    def register(tile, geobox, val):
+    if persist is None:
+        persist = default_persist
+
+    keys = sorted(gridspecs, key=lambda k: abs(gridspecs[k].tile_size[0]*gridspecs[k].tile_size[1]))
+    roots = []
+    derived = {}
+    for k in keys:
+        root = next((r for r in roots if _is_nested(gridspecs[r], gridspecs[k])), None)
+        if root is None:
+            roots.append(k)
+            derived[k] = []
+        else:
+            derived[root].append((k, _mk_parent_index(gridspecs[root], gridspecs[k])))
+
+    all_cells = {k: {} for k in keys}
+    geobox_caches = {k: {} for k in roots}
+    new_acc, append = _accumulator(compact)
+
+    def register(cells, tile, geobox, val):
         cell = cells.get(tile)
         if cell is None:
-            cells[tile] = SimpleNamespace(geobox=geobox, idx=tile, dss=[val])
+            cells[tile] = SimpleNamespace(geobox=geobox, idx=tile, dss=new_acc(val))
         else:
-            cell.dss.append(val)
-
-    if persist is None:
-        persist = default_persist
+            append(cell.dss, val)
 
     for ds in dss:
         ds_val = persist(ds)
@@ -75,13 +142,37 @@ def bin_dataset_stream(gridspec, dss, persist=None):
             print('WARNING: Datasets without extent info: %s' % str(ds.id))
             continue
 
-        for tile, geobox in gridspec.tiles_from_geopolygon(ds.extent, geobox_cache=geobox_cache):
-            register(tile, geobox, ds_val)
+        for root in roots:
+            gridspec, cells = gridspecs[root], all_cells[root]
+            tiles = []
+            for tile, geobox in gridspec.tiles_from_geopolygon(ds.extent,
+                                                               geobox_cache=geobox_caches[root]):
+                register(cells, tile, geobox, ds_val)
+                tiles.append(tile)
 
-    return cells
+            for k, parent in derived[root]:
+                cells = all_cells[k]
+                for tile in set(map(parent, tiles)):
+                    if tile not in cells:
+                        register(cells, tile, gridspecs[k].tile_geobox(tile), ds_val)
+                    else:
+                        append(cells[tile].dss, ds_val)
+
+    return all_cells
+
+
+def bin_dataset_stream(gridspec, dss, persist=None, compact=False):
+    """
+
+    :param gridspec: GridSpec
+    :param dss: Sequence of datasets (can be lazy)
+    :param persist: Dataset -> SomeThing mapping, defaults to keeping dataset id only
+    :param compact: Store cell members as ``bytearray`` of 16 byte keys, see ``bin_dataset_stream_multi``
+    """
+    return bin_dataset_stream_multi({None: gridspec}, dss, persist=persist, compact=compact)[None]
 
 
-def bin_by_native_tile(dss, persist=None, native_tile_id=None):
+def bin_by_native_tile(dss, persist=None, native_tile_id=None, compact=False):
     """Group datasets by native tiling, like path/row for Landsat.
 
     :param dss: Sequence of datasets (can be lazy)
@@ -92,19 +183,22 @@ def bin_by_native_tile(dss, persist=None, native_tile_id=None):
     :param native_tile_id: Dataset -> Key, defaults to extracting `path,row`
     tuple from metadata's `tile_id` field, but could be anything, only
     constraint is that Key value can be used as index to python dict.
+
+    :param compact: Store cell members as ``bytearray`` of 16 byte keys, see ``bin_dataset_stream_multi``
     """
 
     cells = {}
+    new_acc, append = _accumulator(compact)
 
     def default_persist(ds):
-        return ds.id
+        return ds.id.bytes if compact else ds.id
 
     def register(tile, val):
         cell = cells.get(tile)
         if cell is None:
-            cells[tile] = SimpleNamespace(idx=tile, dss=[val])
+            cells[tile] = SimpleNamespace(idx=tile, dss=new_acc(val))
         else:
-            cell.dss.append(val)
+            append(cell.dss, val)
 
     native_tile_id = native_tile_id or extract_ls_path_row
     persist = persist or default_persist
@@ -118,3 +212,27 @@ def bin_by_native_tile(dss, persist=None, native_tile_id=None):
             register(tile, ds_val)
 
     return cells
+
+
+def test_bin_multi_matches_single():
+    from datacube.model import GridSpec
+    from datacube.utils.geometry import CRS
+    from .synthetic import gen_datasets
+
+    dss = list(gen_datasets(200))
+    gridspecs = {zoom: web_gs(zoom) for zoom in range(5, 10)}
+    gridspecs['albers'] = GridSpec(crs=CRS('EPSG:3577'),
+                                   tile_size=(100000.0, 100000.0),
+                                   resolution=(-25, 25))
+
+    for compact in (False, True):
+        multi = bin_dataset_stream_multi(gridspecs, iter(dss), compact=compact)
+        assert set(multi) == set(gridspecs)
+
+        for k, gridspec in gridspecs.items():
+            single = bin_dataset_stream(gridspec, iter(dss), compact=compact)
+            assert set(multi[k]) == set(single)
+            for idx, cell in single.items():
+                assert multi[k][idx].idx == cell.idx
+                assert multi[k][idx].dss == cell.dss
+                assert multi[k][idx].geobox == cell.geobox
@@ -17,11 +17,12 @@ setup(
                       'dea-proto[async]',
                       ],
     tests_require=['pytest'],
-    extras_require=dict(),
+    extras_require=dict(export=['pyarrow']),
     entry_points={
         'console_scripts': [
             'slurpy = dscache.apps.slurpy:cli',
             'dstiler = dscache.apps.dstiler:cli',
+            'dscache = dscache.apps.cli:cli',
         ]
     }
 )